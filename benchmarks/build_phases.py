@@ -0,0 +1,211 @@
+#! /usr/bin/env python3
+
+"""Times each phase of building a site from synthetic songbooks of various sizes, for catching performance regressions.
+
+Songbooks of each size are generated (once, and reused while the generated songs are unchanged) with the Example
+templates and static files, and songs with a realistic spread of tags, AKA titles, "See:" references and titles
+whose slugs collide.  Each is built twice, in a separate process: cold (with no cache or existing output) and warm
+(rebuilding the same site again).  The wall and CPU time of each phase, and the peak memory used by the end of it,
+are written as JSON, which can be compared with the results from another commit using --compare.
+"""
+
+import sys
+import os
+import argparse
+import datetime
+import json
+import logging
+import platform
+import random
+import resource
+import shutil
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir))
+import songbook
+
+EXAMPLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, "Example")
+CORPUS_FORMAT_VERSION = 1
+SYLLABLES = ["ba", "be", "bo", "da", "del", "fa", "fi", "ga", "ho", "ja", "ka", "ki", "la", "lo", "ly", "ma", "mi", "mo",
+             "na", "ne", "no", "pa", "pi", "ra", "re", "ro", "sa", "se", "so", "ta", "te", "to", "va", "wa", "we", "yo"]
+
+
+class Corpus:
+    """Generates the song files of a synthetic songbook, deterministically from a seed."""
+    def __init__(self, size, seed):
+        self.size = size
+        self.seed = seed
+        self.random = random.Random("%d-%d" % (seed, size))
+        self.words = sorted(set(self.word() for _ in range(3000)))
+        self.categories = sorted(set(self.phrase(1, 2).title() for _ in range(max(10, size // 50))))
+        # Earlier categories are used far more than later ones, as in real songbooks.
+        self.category_weights = [1 / (rank + 1) for rank in range(len(self.categories))]
+
+    def word(self):
+        return "".join(self.random.choice(SYLLABLES) for _ in range(self.random.randint(1, 4)))
+
+    def phrase(self, min_words, max_words):
+        return " ".join(self.random.choice(self.words) for _ in range(self.random.randint(min_words, max_words)))
+
+    def lyrics(self):
+        verses = []
+        for verse in range(self.random.randint(2, 6)):
+            lines = [self.phrase(4, 9).capitalize() + self.random.choice([",", ",", "", ".", "!"]) for _ in range(4)]
+            if self.random.random() < 0.2:
+                lines.insert(0, "**%s:**" % self.random.choice(["Chorus", "Refrain", "Verse %d" % (verse + 1)]))
+            if self.random.random() < 0.1:
+                lines.append("_(%s)_" % self.phrase(2, 4))
+            verses.append("\n".join(lines))
+        return "\n\n".join(verses)
+
+    def songs(self):
+        """Yield a (filename, contents) tuple for each song file."""
+        titles = []
+        for index in range(self.size):
+            if titles and self.random.random() < 0.05:
+                # The same title with different punctuation or case, so the songs' slugs collide.
+                title = self.random.choice(titles) + self.random.choice(["!", "?", " (2)", ""])
+                title = title.upper() if self.random.random() < 0.5 else title
+            else:
+                title = self.phrase(1, 5).title()
+            titles.append(title)
+            tags = [("Title", title)]
+            if self.random.random() < 0.3:
+                tags.append(("AKA", ", ".join(self.phrase(1, 4).title() for _ in range(self.random.randint(1, 3)))))
+            if index and self.random.random() < 0.2:
+                tags.append(("See", ", ".join(self.random.choice(titles[:-1]) for _ in range(self.random.randint(1, 3)))))
+            if self.random.random() < 0.9:
+                categories = self.random.choices(self.categories, self.category_weights, k=self.random.randint(1, 4))
+                tags.append(("Tags", ", ".join(sorted(set(categories)))))
+            if self.random.random() < 0.5:
+                tags.append(("Source", self.phrase(2, 3).title()))
+            if self.random.random() < 0.1:
+                tags.append(("Copyright", "© %d %s" % (self.random.randint(1900, 2020), self.phrase(1, 2).title())))
+            header = "".join("%s: %s\n" % tag for tag in tags)
+            yield "%06d-%s%s" % (index, songbook.slugify(title)[:40], songbook.SONG_EXTENSION), header + "\n" + self.lyrics() + "\n"
+
+    def generate(self, path):
+        """Create a songbook source directory at path, unless one was already generated there with the same settings."""
+        marker_path = os.path.join(path, "corpus.json")
+        marker = {"version": CORPUS_FORMAT_VERSION, "size": self.size, "seed": self.seed}
+        try:
+            with open(marker_path) as marker_file:
+                if json.load(marker_file) == marker:
+                    return
+        except (OSError, ValueError):
+            pass
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        songs_path = os.path.join(path, "songs")
+        os.makedirs(songs_path)
+        for name in ("templates", "static"):
+            shutil.copytree(os.path.join(EXAMPLE_PATH, name), os.path.join(path, name))
+        for filename, contents in self.songs():
+            with open(os.path.join(songs_path, filename), "w", encoding=songbook.SONG_ENCODING) as song_file:
+                song_file.write(contents)
+        with open(marker_path, "w") as marker_file:
+            json.dump(marker, marker_file)
+
+
+def build(source, destination, cache_dir, jobs):
+    """Build the site at source with SiteBuilder.build_site, returning the timings of each phase of the build (as
+    recorded by its BuildProfile, plus setting up the SiteBuilder)."""
+    peak_rss = {}
+    def record_peak_rss(name):
+        peak_rss[name] = {"peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                          "peak_worker_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}
+    profile = songbook.BuildProfile(on_phase=record_peak_rss)
+    with profile.phase("setup"):
+        site_builder = songbook.SiteBuilder(source, destination, [], "", cache_dir=cache_dir, jobs=jobs, profile=profile)
+    site_builder.build_site()
+    return {name: dict({"wall": wall, "cpu": cpu}, **peak_rss[name])
+            for name, (wall, cpu, runs) in profile.phases.items() if name in peak_rss}
+
+
+def compare(results, baseline_results, threshold):
+    """Print (to stderr) the ratio of each phase's wall time to that in baseline_results, returning whether any exceed threshold."""
+    baseline = {(run["songs"], run["run"]): run["phases"] for run in baseline_results["runs"]}
+    regressed = False
+    print("%8s %5s %-18s %10s %10s %7s" % ("songs", "run", "phase", "baseline", "current", "ratio"), file=sys.stderr)
+    for run in results["runs"]:
+        for name, timing in run["phases"].items():
+            old_timing = baseline.get((run["songs"], run["run"]), {}).get(name)
+            if not old_timing:
+                continue
+            ratio = timing["wall"] / old_timing["wall"] if old_timing["wall"] else 1
+            flag = ""
+            if ratio > threshold and timing["wall"] - old_timing["wall"] > 0.05:
+                flag = " *"
+                regressed = True
+            print("%8d %5s %-18s %9.3fs %9.3fs %6.2fx%s" % (run["songs"], run["run"], name, old_timing["wall"],
+                                                             timing["wall"], ratio, flag), file=sys.stderr)
+    return regressed
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=EXAMPLE_PATH,
+                                       stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", help="Comma separated numbers of songs to benchmark. (Default: %(default)s).",
+                        default="1000,10000,100000")
+    parser.add_argument("--seed", help="Seed for generating the songs. (Default: %(default)d).", type=int, default=1)
+    parser.add_argument("--work-dir", help="Where to generate the songbooks and build the sites; generated songbooks "
+                        "are kept for reuse. (Default: %(default)s).", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "work"))
+    parser.add_argument("-j", "--jobs", help="Number of worker processes used by the builds. (Default: %(default)d).",
+                        type=int, default=1)
+    parser.add_argument("--output", help="File to write the results to, as JSON. (Default: standard output).")
+    parser.add_argument("--compare", help="A results file (e.g. from another commit) to compare these results with.")
+    parser.add_argument("--threshold", help="With --compare, exit with an error if any phase takes more than this many "
+                        "times as long as before. (Default: %(default)s).", type=float, default=1.25)
+    parser.add_argument("--run", help=argparse.SUPPRESS, nargs=4, metavar=("SOURCE", "DESTINATION", "CACHE", "JOBS"))
+    args = parser.parse_args()
+    songbook.configure_logging(logging.ERROR)
+
+    if args.run:
+        # A single build, run in its own process so its peak memory is measured separately.
+        source, destination, cache_dir, jobs = args.run
+        json.dump(build(source, destination, cache_dir, int(jobs)), sys.stdout)
+        return
+
+    results = {"commit": git_commit(), "version": songbook.__version__, "python": platform.python_version(),
+               "platform": platform.platform(), "date": datetime.datetime.now().isoformat(timespec="seconds"),
+               "jobs": args.jobs, "seed": args.seed, "runs": []}
+    for size in [int(size) for size in args.sizes.split(",")]:
+        source = os.path.join(args.work_dir, "songs-%d" % size)
+        destination = os.path.join(args.work_dir, "site-%d" % size)
+        cache_dir = os.path.join(args.work_dir, "cache-%d" % size)
+        print("Generating %d songs..." % size, file=sys.stderr)
+        Corpus(size, args.seed).generate(source)
+        for path in (destination, cache_dir):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        for run in ("cold", "warm"):
+            print("Building %d songs (%s)..." % (size, run), file=sys.stderr)
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--run", source, destination,
+                                              cache_dir, str(args.jobs)])
+            phases = json.loads(output.decode("utf-8"))
+            results["runs"].append({"songs": size, "run": run, "phases": phases,
+                                    "total": sum(timing["wall"] for timing in phases.values())})
+            print("  %.2fs: %s" % (results["runs"][-1]["total"], ", ".join("%s %.2fs" % (name, timing["wall"])
+                                                                            for name, timing in phases.items())), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            if compare(results, json.load(baseline_file), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
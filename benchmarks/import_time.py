@@ -0,0 +1,119 @@
+#! /usr/bin/env python3
+
+"""Measures how long songbook takes to start up, for catching regressions in import time.
+
+Runs `songbook.py --version` and `--help` (each several times, in a fresh process) with Python's -X importtime, and
+reports the median total time of each command, the median import time of the songbook module, and the modules which
+took longest to import.  It also checks that none of the heavier modules which songbook only imports where they're
+used (Markdown, Jinja, the webserver, etc.) are imported at startup, exiting with an error if any are.  The results
+are written as JSON, which can be compared with the results from another commit using --compare.
+"""
+
+import sys
+import os
+import argparse
+import datetime
+import json
+import platform
+import re
+import statistics
+import subprocess
+import time
+
+SONGBOOK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, "songbook.py")
+COMMANDS = {"version": ["--version"], "help": ["--help"]}
+# Modules songbook should only import when they're needed (see the imports at the top of songbook.py).
+LAZY_MODULES = ["markdown", "jinja2", "http.server", "email.utils", "subprocess", "pickle", "multiprocessing",
+                "cProfile", "watchdog", "sqlite3"]
+IMPORT_TIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def run(arguments):
+    """Run songbook with arguments under -X importtime, returning the wall time and {module: (self, cumulative) µs}."""
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, "-X", "importtime", SONGBOOK_PATH] + arguments,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    wall = time.perf_counter() - start
+    imports = {}
+    for line in process.stderr.decode("utf-8").splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            imports[match.group(4)] = (int(match.group(1)), int(match.group(2)))
+    return wall, imports
+
+
+def measure(arguments, repeat, top):
+    """Run a command repeat times, returning the median timings, the slowest imports and any lazy modules imported."""
+    runs = [run(arguments) for _ in range(repeat)]
+    imported = set.intersection(*(set(imports) for wall, imports in runs))
+    slowest = sorted(imported, key=lambda name: -statistics.median(imports[name][1] for wall, imports in runs))
+    return {"wall": statistics.median(wall for wall, imports in runs),
+            "imports": statistics.median(sum(own for own, cumulative in imports.values()) for wall, imports in runs) / 1e6,
+            "modules": len(imported),
+            "slowest": {name: statistics.median(imports[name][1] for wall, imports in runs) / 1e6 for name in slowest[:top]},
+            "lazy_modules_imported": sorted(name for name in LAZY_MODULES if name in imported)}
+
+
+def compare(results, baseline_results, threshold):
+    """Print (to stderr) the ratio of each command's times to those in baseline_results, returning whether any exceed threshold."""
+    regressed = False
+    print("%-8s %-8s %10s %10s %7s" % ("command", "time", "baseline", "current", "ratio"), file=sys.stderr)
+    for name, timing in results["commands"].items():
+        old_timing = baseline_results["commands"].get(name)
+        if not old_timing:
+            continue
+        for key in ("wall", "imports"):
+            ratio = timing[key] / old_timing[key] if old_timing[key] else 1
+            flag = ""
+            if ratio > threshold and timing[key] - old_timing[key] > 0.005:
+                flag = " *"
+                regressed = True
+            print("%-8s %-8s %9.3fs %9.3fs %6.2fx%s" % (name, key, old_timing[key], timing[key], ratio, flag), file=sys.stderr)
+    return regressed
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(SONGBOOK_PATH),
+                                       stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", help="Number of times to run each command. (Default: %(default)d).", type=int, default=10)
+    parser.add_argument("--top", help="Number of slowest imports to list. (Default: %(default)d).", type=int, default=10)
+    parser.add_argument("--output", help="File to write the results to, as JSON. (Default: standard output).")
+    parser.add_argument("--compare", help="A results file (e.g. from another commit) to compare these results with.")
+    parser.add_argument("--threshold", help="With --compare, exit with an error if any time is more than this many "
+                        "times as long as before. (Default: %(default)s).", type=float, default=1.25)
+    args = parser.parse_args()
+
+    results = {"commit": git_commit(), "python": platform.python_version(), "platform": platform.platform(),
+               "date": datetime.datetime.now().isoformat(timespec="seconds"), "repeat": args.repeat, "commands": {}}
+    failed = False
+    for name, arguments in COMMANDS.items():
+        timing = results["commands"][name] = measure(arguments, args.repeat, args.top)
+        print("%s: %.3fs (%.3fs importing %d modules); slowest: %s" % (name, timing["wall"], timing["imports"],
+              timing["modules"], ", ".join("%s %.3fs" % item for item in list(timing["slowest"].items())[:5])), file=sys.stderr)
+        if timing["lazy_modules_imported"]:
+            print("  imported at startup: %s" % ", ".join(timing["lazy_modules_imported"]), file=sys.stderr)
+            failed = True
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            if compare(results, json.load(baseline_file), args.threshold):
+                failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#! /usr/bin/env python3
+
+"""Checks that the fast lyrics renderer gives exactly the same HTML as Markdown, and times the two.
+
+Every song in the given songs directories (by default, the Example songs) is rendered both by Markdown (with the
+same extensions as Song.markdown) and by songbook.render_simple_lyrics.  Any song the fast renderer handles must
+come out byte for byte the same, or the differences are printed and the exit status is 1.  Optionally, lyrics from
+the synthetic songbook of benchmarks/build_phases.py, and random fragments of lyrics and Markdown syntax (--fuzz),
+are checked too.
+"""
+
+import sys
+import os
+import argparse
+import random
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir))
+import songbook
+import markdown
+
+EXAMPLE_SONGS_PATH = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, "Example", "songs"))
+FUZZ_FRAGMENTS = ["don't", "Puddin'", " 'Tis", "'s", "'90s", "**Chorus:**", "_la la_", "*oh*", "__hey__", "x_y", "a",
+                  "b", "s", "T", "é", "Ω", "1", "9", " ", " ", "\u00a0", "\t", "\n", "\n\n", "'", "\"", "’", "*", "**",
+                  "_", "__", ".", "...", ",", "-", "--", ":", "!", "(", ")", "=", "+", "#", "<b>", "&", "[x](y)", "`"]
+
+
+def songbook_lyrics(path):
+    """Yield a (name, lyrics) tuple for each song file in the directory at path."""
+    for filepath, filename in songbook.discover_song_files(path):
+        with open(filepath, "rb") as song_file:
+            yield filename, songbook.Song.from_string(songbook.decode_song(song_file.read(), filename), filename=filename).raw_lyrics
+
+
+def synthetic_lyrics(size, seed):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from build_phases import Corpus
+    for filename, contents in Corpus(size, seed).songs():
+        yield filename, songbook.Song.from_string(contents, filename=filename).raw_lyrics
+
+
+def fuzz_lyrics(count, seed):
+    generator = random.Random(seed)
+    for index in range(count):
+        text = "".join(generator.choice(FUZZ_FRAGMENTS) for _ in range(generator.randint(1, 40))).strip()
+        yield "fuzz-%d" % index, text
+
+
+def check(name, lyrics, markdown_renderer):
+    """Render lyrics both ways, returning the time taken by each (the fast renderer's is None if it declined) and
+    whether they match."""
+    start = time.perf_counter()
+    expected = markdown_renderer.reset().convert(lyrics)
+    markdown_time = time.perf_counter() - start
+    start = time.perf_counter()
+    html = songbook.render_simple_lyrics(lyrics)
+    fast_time = time.perf_counter() - start
+    if html is None:
+        return markdown_time, None, True
+    if html != expected:
+        print("Mismatch in %s:\n  lyrics:   %r\n  markdown: %r\n  fast:     %r" % (name, lyrics, expected, html), file=sys.stderr)
+        return markdown_time, fast_time, False
+    return markdown_time, fast_time, True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("songs", help="Songs directories to check. (Default: the Example songs).", nargs="*")
+    parser.add_argument("--synthetic", help="Also check the lyrics of a synthetic songbook of this many songs.", type=int, default=0)
+    parser.add_argument("--fuzz", help="Also check this many random fragments of lyrics.", type=int, default=0)
+    parser.add_argument("--seed", help="Seed for the synthetic songbook and fuzzing. (Default: %(default)d).", type=int, default=1)
+    args = parser.parse_args()
+
+    markdown_renderer = markdown.Markdown(extensions=["markdown.extensions.nl2br", "markdown.extensions.smarty"],
+                                          output_format="html5")
+    sources = [(path, songbook_lyrics(path)) for path in args.songs or [EXAMPLE_SONGS_PATH]]
+    if args.synthetic:
+        sources.append(("synthetic", synthetic_lyrics(args.synthetic, args.seed)))
+    if args.fuzz:
+        sources.append(("fuzz", fuzz_lyrics(args.fuzz, args.seed)))
+    failed = False
+    for source, lyrics in sources:
+        count = fast = mismatches = 0
+        markdown_total = fast_total = markdown_fast_total = 0
+        for name, text in lyrics:
+            markdown_time, fast_time, matched = check(name, text, markdown_renderer)
+            count += 1
+            markdown_total += markdown_time
+            if fast_time is not None:
+                fast += 1
+                fast_total += fast_time
+                markdown_fast_total += markdown_time
+            if not matched:
+                mismatches += 1
+        print("%s: %d songs, %d rendered by the fast renderer (%.1f%%), %d mismatched" % (source, count, fast,
+              100 * fast / count if count else 0, mismatches))
+        if fast:
+            print("  those took %.3fs with Markdown, %.3fs with the fast renderer (%.1fx faster); all songs with Markdown: %.3fs"
+                  % (markdown_fast_total, fast_total, markdown_fast_total / fast_total if fast_total else 0, markdown_total))
+        failed = failed or mismatches > 0
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
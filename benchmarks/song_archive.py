@@ -0,0 +1,92 @@
+#! /usr/bin/env python3
+
+"""Times loading a songbook from a directory of song files and from each format of song archive, and checks they match.
+
+A synthetic songbook (as generated by benchmarks/build_phases.py) is exported to a JSON Lines and a SQLite song archive
+(with songbook.export_songs), and the songs are loaded from the directory and from each archive in turn (with no
+cache, in a separate process each, so the files aren't already open or parsed).  The songs loaded from each archive
+must be exactly the same as those loaded from the directory, or the exit status is 1.  The time taken to export
+each archive, its size, and the wall time and peak memory of loading the songs from each source are written as JSON.
+"""
+
+import sys
+import os
+import argparse
+import hashlib
+import json
+import logging
+import resource
+import subprocess
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir))
+import songbook
+from build_phases import Corpus
+
+FORMATS = {"jsonl": "songs.jsonl", "sqlite": "songs.sqlite"}
+
+
+def load(source, archive, jobs, low_memory):
+    """Load the songs from source's songs directory (or archive, if given), returning the timings and a digest of the songs."""
+    start = time.perf_counter()
+    book = songbook.SongBook(os.path.join(source, "songs"), jobs=jobs, low_memory=low_memory,
+                             archive=songbook.SongArchive(archive) if archive else None)
+    wall = time.perf_counter() - start
+    records = [song.to_metadata_record() if low_memory else song.to_record()
+               for song in sorted(book.songs, key=lambda song: song.filename)]
+    return {"wall": wall, "songs": len(records), "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "digest": hashlib.sha1(repr(records).encode("utf-8")).hexdigest()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", help="Number of songs in the synthetic songbook. (Default: %(default)d).", type=int, default=10000)
+    parser.add_argument("--seed", help="Seed for generating the songs. (Default: %(default)d).", type=int, default=1)
+    parser.add_argument("--work-dir", help="Where to generate the songbook and archives; the generated songbook is kept "
+                        "for reuse. (Default: %(default)s).", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "work"))
+    parser.add_argument("-j", "--jobs", help="Number of worker processes used to parse the songs. (Default: %(default)d).",
+                        type=int, default=1)
+    parser.add_argument("--low-memory", help="Load the songs as a low memory build would.", action="store_true")
+    parser.add_argument("--output", help="File to write the results to, as JSON. (Default: standard output).")
+    parser.add_argument("--run", help=argparse.SUPPRESS, nargs=2, metavar=("SOURCE", "ARCHIVE"))
+    args = parser.parse_args()
+    songbook.configure_logging(logging.ERROR)
+
+    if args.run:
+        # A single load, run in its own process so its peak memory is measured separately.
+        source, archive = args.run
+        json.dump(load(source, archive or None, args.jobs, args.low_memory), sys.stdout)
+        return
+
+    source = os.path.join(args.work_dir, "songs-%d" % args.size)
+    print("Generating %d songs..." % args.size, file=sys.stderr)
+    Corpus(args.size, args.seed).generate(source)
+    results = {"version": songbook.__version__, "songs": args.size, "seed": args.seed, "jobs": args.jobs,
+               "low_memory": args.low_memory, "exports": {}, "loads": {}}
+    for name, filename in FORMATS.items():
+        archive = os.path.join(args.work_dir, "songs-%d-%s" % (args.size, filename))
+        start = time.perf_counter()
+        songbook.export_songs(os.path.join(source, "songs"), archive)
+        results["exports"][name] = {"wall": time.perf_counter() - start, "size": os.path.getsize(archive), "path": archive}
+    for name, archive in [("directory", "")] + [(name, export["path"]) for name, export in results["exports"].items()]:
+        command = [sys.executable, os.path.abspath(__file__), "--run", source, archive, "--jobs", str(args.jobs)]
+        output = subprocess.check_output(command + (["--low-memory"] if args.low_memory else []))
+        results["loads"][name] = json.loads(output.decode("utf-8"))
+        print("%s: loaded %d songs in %.2fs" % (name, results["loads"][name]["songs"], results["loads"][name]["wall"]),
+              file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    expected = results["loads"]["directory"]["digest"]
+    mismatched = [name for name, timing in results["loads"].items() if timing["digest"] != expected]
+    if mismatched:
+        print("Songs loaded from %s don't match those loaded from the directory" % ", ".join(mismatched), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
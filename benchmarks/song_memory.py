@@ -0,0 +1,85 @@
+#! /usr/bin/env python3
+
+"""Measures the memory used by each Song object, for comparing changes to the song model.
+
+Each song file is parsed a number of times (as if it were a larger songbook), and the memory allocated for the
+resulting Songs is measured with tracemalloc, both straight after parsing and after their lyrics and first lines
+have been used (as when rendering).  The size of each Song and the values it holds is also totalled with
+sys.getsizeof, not counting any objects shared with other songs.
+"""
+
+import sys
+import os
+import argparse
+import gc
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir))
+import songbook
+
+
+def getsizeof_song(song):
+    """Return the size of a song object and the values it holds (but not other Songs or Categories it links to)."""
+    seen = set()
+    def sizeof(value):
+        if id(value) in seen or isinstance(value, (songbook.Song, songbook.Category)):
+            return 0
+        seen.add(id(value))
+        size = sys.getsizeof(value)
+        if isinstance(value, dict):
+            size += sum(sizeof(key) + sizeof(item) for key, item in value.items())
+        elif isinstance(value, (list, tuple)):
+            size += sum(sizeof(item) for item in value)
+        return size
+    seen.add(id(song))
+    size = sys.getsizeof(song)
+    if hasattr(song, "__dict__"):
+        size += sizeof(song.__dict__)
+    for cls in type(song).__mro__:
+        for slot in getattr(cls, "__slots__", ()):
+            if hasattr(song, slot):
+                size += sizeof(getattr(song, slot))
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--songs", help="The directory of song files to parse. (Default: the Example songs).",
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, "Example", "songs"))
+    parser.add_argument("--copies", help="How many times to parse each song. (Default: %(default)d).", type=int, default=20)
+    args = parser.parse_args()
+
+    contents = []
+    for filename in sorted(os.listdir(args.songs)):
+        if filename.endswith(songbook.SONG_EXTENSION):
+            with open(os.path.join(args.songs, filename), encoding=songbook.SONG_ENCODING) as song_file:
+                contents.append((filename, song_file.read()))
+    # Load Markdown (and its extensions) before measuring, with lyrics that the fast renderer leaves to Markdown.
+    songbook.render_lyrics("> Load Markdown -- before measuring...")
+    songbook.render_lyrics.cache_clear()
+
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.take_snapshot()
+    songs = [songbook.Song.from_string(text, "%d-%s" % (copy, filename)) for copy in range(args.copies) for filename, text in contents]
+    gc.collect()
+    parsed = tracemalloc.take_snapshot()
+    for song in songs:
+        # Copies of a song would otherwise share their lyrics' HTML (see render_lyrics), unlike the songs of a real songbook.
+        songbook.render_lyrics.cache_clear()
+        song.lyrics, song.first_line, song.slug
+    gc.collect()
+    used = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    def per_song(snapshot):
+        return sum(stat.size_diff for stat in snapshot.compare_to(baseline, "filename")) / len(songs)
+    print("%d songs" % len(songs))
+    print("Allocated per song after parsing:        %8.0f bytes" % per_song(parsed))
+    print("Allocated per song after use:            %8.0f bytes" % per_song(used))
+    print("sys.getsizeof of each Song object:       %8.0f bytes" % (sum(sys.getsizeof(song) for song in songs) / len(songs)))
+    print("sys.getsizeof of each Song and contents: %8.0f bytes" % (sum(getsizeof_song(song) for song in songs) / len(songs)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#! /usr/bin/env python3
+
+"""Checks that a watched site ends up the same as a full build after each of a series of changes to its songs.
+
+A copy of the Example songbook (with a few of its songs moved into a subdirectory) is built and watched with watchdog,
+as `songbook.py --watch` would, and changed one step at a time: songs are edited, and the subdirectory is moved out of
+the songs directory, back in under another name, and renamed.  After each step (once the rebuild has had time to
+finish) the site is compared with a full build of the changed source, and any differing files are listed.  The exit
+status is 1 if any step's site differs.  Requires the watchdog package.
+"""
+
+import sys
+import os
+import argparse
+import filecmp
+import logging
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir))
+import songbook
+
+EXAMPLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, "Example")
+SUBDIRECTORY_SONGS = ["Humpty Dumpty.txt", "Jack Sprat.txt", "Hot Cross Buns.txt"]
+IGNORED_OUTPUTS = {"about", songbook.MANIFEST_FILENAME} # The about page (and its digest in the manifest) include the build time.
+
+
+def differences(expected, actual, rel_dir=""):
+    """Return the paths (relative to both directories) of files which differ, or are only in one of them."""
+    comparison = filecmp.dircmp(os.path.join(expected, rel_dir), os.path.join(actual, rel_dir), ignore=list(IGNORED_OUTPUTS))
+    paths = [os.path.join(rel_dir, name) for name in comparison.left_only + comparison.right_only + comparison.funny_files]
+    paths.extend(os.path.join(rel_dir, name) for name in comparison.common_files
+                 if not filecmp.cmp(os.path.join(expected, rel_dir, name), os.path.join(actual, rel_dir, name), shallow=False))
+    for name in comparison.common_dirs:
+        paths.extend(differences(expected, actual, os.path.join(rel_dir, name)))
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--settle", help="Seconds to wait for each rebuild to finish. (Default: %(default)s).", type=float, default=2)
+    parser.add_argument("--work-dir", help="Where to copy the songbook and build the sites. (Default: a temporary directory).")
+    args = parser.parse_args()
+    songbook.configure_logging(logging.ERROR)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="songbook-watch-")
+    source, outside = os.path.join(work_dir, "source"), os.path.join(work_dir, "outside")
+    destination, full_destination = os.path.join(work_dir, "site"), os.path.join(work_dir, "full-site")
+    for path in (source, outside, destination, full_destination):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+    shutil.copytree(EXAMPLE_PATH, source, ignore=shutil.ignore_patterns(".songbook-cache", "site"))
+    os.makedirs(outside)
+    songs_path = os.path.join(source, "songs")
+    os.makedirs(os.path.join(songs_path, "collection"))
+    for filename in SUBDIRECTORY_SONGS:
+        os.rename(os.path.join(songs_path, filename), os.path.join(songs_path, "collection", filename))
+
+    def edit(rel_path, old, new):
+        path = os.path.join(songs_path, rel_path)
+        with open(path, encoding=songbook.SONG_ENCODING) as song_file:
+            contents = song_file.read()
+        with open(path, "w", encoding=songbook.SONG_ENCODING) as song_file:
+            song_file.write(contents.replace(old, new))
+
+    steps = [
+        ("retitle a song", lambda: edit("Jack and Jill.txt", "Title: Jack and Jill", "Title: Jack and Jill Again")),
+        ("edit a song in the subdirectory", lambda: edit(os.path.join("collection", "Jack Sprat.txt"), "Sprat", "Spratt")),
+        ("move the subdirectory out", lambda: os.rename(os.path.join(songs_path, "collection"), os.path.join(outside, "collection"))),
+        ("move it back in, renamed", lambda: os.rename(os.path.join(outside, "collection"), os.path.join(songs_path, "collection2"))),
+        ("rename it", lambda: os.rename(os.path.join(songs_path, "collection2"), os.path.join(songs_path, "collection3"))),
+        ("delete a song in it", lambda: os.remove(os.path.join(songs_path, "collection3", "Hot Cross Buns.txt"))),
+    ]
+
+    site_builder = songbook.SiteBuilder(source, destination, [], None, cache_dir=os.path.join(work_dir, "cache"))
+    site_builder.build_site()
+    scheduler = songbook.RebuildScheduler(site_builder, delay=0.2)
+    scheduler.start()
+    observer = scheduler.watch(source)
+    failed = False
+    try:
+        for label, change in steps:
+            change()
+            time.sleep(args.settle)
+            shutil.rmtree(full_destination, ignore_errors=True)
+            songbook.SiteBuilder(source, full_destination, [], None).build_site()
+            different = differences(full_destination, destination)
+            print("%s: %s" % (label, "same as a full build" if not different else
+                              "%d files differ from a full build: %s" % (len(different), ", ".join(sorted(different)))))
+            failed = failed or bool(different)
+    finally:
+        observer.stop()
+        observer.join()
+        scheduler.stop()
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
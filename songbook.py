@@ -12,21 +12,57 @@ import argparse
 import re
 import unicodedata
 import collections
-import http.server
 import posixpath
 import urllib
 import datetime
 import time
-import subprocess
-
-try:
-    import markdown
-    import jinja2
-except ImportError as error:
-    logging.error(" The required package \"%s\" was not found, please check the installation instructions." % error.name)
-    sys.exit(-1)
+import hashlib
+import concurrent.futures
+import threading
+import filecmp
+import json
+import functools
+import io
+import gzip
+import contextlib
+import codecs
+import fnmatch
+import importlib.util
+
+# Heavier modules (these, the webserver, etc.) are only imported where they're used, so that e.g. --help and --version
+# don't wait for them to load; see benchmarks/import_time.py.  The required packages are still checked for up front.
+REQUIRED_PACKAGES = ("markdown", "jinja2")
+for package in REQUIRED_PACKAGES:
+    if importlib.util.find_spec(package) is None:
+        logging.error(" The required package \"%s\" was not found, please check the installation instructions." % package)
+        sys.exit(-1)
 
 SONG_EXTENSION = ".txt"
+SONG_ENCODING = "utf-8"
+SONG_PATTERNS = ("*" + SONG_EXTENSION,)
+READ_THREADS = 8
+SONG_ARCHIVE_FORMATS = {".jsonl": "jsonl", ".sqlite": "sqlite", ".sqlite3": "sqlite", ".db": "sqlite"}
+OUTPUT_ENCODING = "utf-8"
+STATIC_MODES = ("copy", "hardlink", "reflink", "symlink")
+SONGS_DIR = "songs"
+CATEGORIES_DIR = "categories"
+SLUG_CACHE_SIZE = 1 << 16
+LYRICS_CACHE_SIZE = 1 << 10
+DEFAULT_SERVER_CACHE_SIZE = 64 << 20
+COMPRESSIBLE_EXTENSIONS = {".html", ".htm", ".css", ".js", ".json", ".svg", ".txt", ".xml"}
+MIN_PRECOMPRESS_SIZE = 256
+SEARCH_DIR = "search"
+SEARCH_FORMAT_VERSION = 2
+SEARCH_PREFIX_LENGTH = 2
+CACHE_FORMAT_VERSION = 1
+CACHE_SAVE_INTERVAL = 30 # Seconds; while watching, the parse cache is written at most this often.
+MANIFEST_FILENAME = ".songbook-manifest.json"
+TEMPLATE_CACHE_DIR = "jinja"
+COMPILED_TEMPLATES_MANIFEST = "templates.json"
+LOG_FORMAT = "%(levelname)s: %(message)s"
+RENDER_CHUNK_SIZE = 200
+WATCH_IGNORE_PATTERNS = ["*/.DS_Store", "*/Thumbs.db", "*.swp", "*.swo", "*~"]
+STREAM_CHUNK_SIZE = 1 << 16
 
 
 def truncate(string, max_length, suffix='…'):
@@ -38,6 +74,7 @@ def truncate(string, max_length, suffix='…'):
         return string[:max_length]
     return string[:max_length - len(suffix)] + suffix
 
+@functools.lru_cache(maxsize=SLUG_CACHE_SIZE)
 def slugify(string):
     """Turns a string into a sluggified version safe for use in URLs.
 
@@ -45,6 +82,8 @@ def slugify(string):
     are converted into a single '-', multiple '-'s will be coalesced, and leading/trailing '-'s are stripped.
     An attempt is made to convert non-ascii characters (e.g. accented letters) to similar ascii characters to
     maintain readability (e.g. "Größe" -> "grosse").
+
+    Results are memoized, as the same titles and tags are slugified many times while linking songs.
     """
     special_translation = string.lower().translate(str.maketrans({'ø':'o', 'ß':'ss', 'œ':'ae',
                                                     '–':'-','—':'-',
@@ -54,9 +93,427 @@ def slugify(string):
     alphanum = re.sub(r"\W+", "-", ascii_only).strip('-')
     return alphanum
 
+def temporary_path(path):
+    """Return a path for a temporary file next to path, unique to this process and thread."""
+    directory, filename = os.path.split(path)
+    return os.path.join(directory, ".%s.%d-%d.tmp" % (filename, os.getpid(), threading.get_ident()))
+
+def publish_file(path, contents):
+    """Write contents (bytes) to the file at path, unless it already contains exactly that.
+
+    The new contents are written to a temporary file first, then renamed into place, so that a partially written file
+    is never visible at path (e.g. to the server).  Returns whether the file was written.
+    """
+    try:
+        if os.path.getsize(path) == len(contents):
+            with open(path, 'rb') as existing_file:
+                if existing_file.read() == contents:
+                    return False
+    except OSError:
+        pass
+    temp_path = temporary_path(path)
+    try:
+        with open(temp_path, 'wb') as temp_file:
+            temp_file.write(contents)
+        os.replace(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return True
+
+def publish_stream(path, chunks, previous=None, profile=None):
+    """Write an iterable of chunks of bytes to the file at path, unless it already contains exactly that.
+
+    Like publish_file, but the contents needn't all be in memory at once: the chunks are written to a temporary file
+    as they're generated, and hashed as they go.  previous is the (SHA-1 digest, modification time in ns) of the file
+    when last published, if known.  If the file's modification time still matches, its contents are assumed to have
+    that digest; otherwise (e.g. it's been edited since) it's compared with the temporary file.
+    Returns a tuple of whether the file was written, the (digest, modification time) of the file, and its size.
+    If a BuildProfile is given, the time taken writing the file (but not generating its chunks, e.g. rendering them) is
+    recorded in it as the phase "writing".
+    """
+    start, start_cpu = time.perf_counter(), time.process_time()
+    generating = [0, 0] # Wall and CPU time spent generating the chunks.
+    temp_path = temporary_path(path)
+    hash = hashlib.sha1()
+    size = 0
+    try:
+        with open(temp_path, 'wb') as temp_file:
+            for chunk in timed_iter(chunks, generating):
+                hash.update(chunk)
+                temp_file.write(chunk)
+                size += len(chunk)
+        digest = hash.hexdigest()
+        try:
+            stat = os.stat(path)
+            if stat.st_size == size and (digest == previous[0] if previous and previous[1] == stat.st_mtime_ns else
+                                         filecmp.cmp(temp_path, path, shallow=False)):
+                os.remove(temp_path)
+                return False, (digest, stat.st_mtime_ns), size
+        except OSError:
+            pass
+        os.replace(temp_path, path)
+        mtime = os.stat(path).st_mtime_ns
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    finally:
+        if profile:
+            profile.add("writing", time.perf_counter() - start - generating[0], time.process_time() - start_cpu - generating[1])
+    return True, (digest, mtime), size
+
+def timed_iter(iterable, elapsed):
+    """Yield the items of an iterable, adding the wall and CPU time taken to produce each of them to elapsed, a list
+    of [wall time, CPU time]."""
+    iterator = iter(iterable)
+    while True:
+        start, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            elapsed[0] += time.perf_counter() - start
+            elapsed[1] += time.process_time() - start_cpu
+        yield item
+
+def encode_chunks(strings, encoding, chunk_size=STREAM_CHUNK_SIZE):
+    """Join an iterable of (typically small) strings into chunks of roughly chunk_size characters, and encode them."""
+    buffer = []
+    buffered = 0
+    for string in strings:
+        buffer.append(string)
+        buffered += len(string)
+        if buffered >= chunk_size:
+            yield "".join(buffer).encode(encoding)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield "".join(buffer).encode(encoding)
+
+def sync_static_file(src_path, path, mode="copy", compare_contents=False):
+    """Make the file at path a copy of the file at src_path, unless it already is one.  Returns whether it was updated.
+
+    A copy is up to date if its size and modification time match the original's (as copies keep the original's
+    metadata), and if compare_contents is set, if its contents are also identical.  Rather than copying, mode can
+    be "hardlink", "reflink" (a copy-on-write clone, on filesystems that support it), or "symlink" (to the absolute
+    path of the original), to avoid duplicating large files.  Hard links and reflinks fall back on copying if they
+    aren't possible (e.g. across filesystems).  In any case, the new file replaces path atomically, as in publish_file.
+    """
+    src_stat = os.stat(src_path)
+    try:
+        stat = os.lstat(path)
+    except FileNotFoundError:
+        stat = None
+    if stat is not None:
+        if mode == "symlink":
+            if os.path.islink(path) and os.readlink(path) == os.path.abspath(src_path):
+                return False
+        elif mode == "hardlink" and os.path.samestat(src_stat, stat):
+            return False
+        elif (not os.path.islink(path) and (mode != "hardlink" or src_stat.st_dev != stat.st_dev)
+              and (stat.st_size, stat.st_mtime_ns) == (src_stat.st_size, src_stat.st_mtime_ns)
+              and (not compare_contents or filecmp.cmp(src_path, path, shallow=False))):
+            return False
+    temp_path = temporary_path(path)
+    try:
+        if mode == "symlink":
+            os.symlink(os.path.abspath(src_path), temp_path)
+        elif mode == "hardlink" and try_link(src_path, temp_path):
+            pass
+        elif mode == "reflink" and try_reflink(src_path, temp_path):
+            shutil.copystat(src_path, temp_path)
+        else:
+            shutil.copy2(src_path, temp_path)
+        os.replace(temp_path, path)
+    except:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        raise
+    return True
+
+def try_link(src_path, path):
+    """Create a hard link at path to src_path, returning whether it was possible."""
+    try:
+        os.link(src_path, path)
+        return True
+    except OSError:
+        return False
+
+FICLONE = 0x40049409 # From linux/fs.h
+
+def try_reflink(src_path, path):
+    """Create a copy-on-write clone of src_path at path, returning whether it was possible (only on Linux)."""
+    try:
+        import fcntl
+        with open(src_path, 'rb') as src_file, open(path, 'wb') as out_file:
+            fcntl.ioctl(out_file.fileno(), FICLONE, src_file.fileno())
+        return True
+    except (ImportError, OSError):
+        if os.path.exists(path):
+            os.remove(path)
+        return False
+
+AT_FDCWD = -100 # From linux/fcntl.h
+RENAME_EXCHANGE = 1 << 1 # From linux/fs.h
+
+def try_exchange(path, other_path):
+    """Atomically swap the files or directories at path and other_path (with renameat2), returning whether it was
+    possible (only on Linux 3.15 or later, and with filesystems which support it)."""
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        renameat2 = libc.renameat2
+    except (ImportError, OSError, AttributeError):
+        return False
+    renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    return renameat2(AT_FDCWD, os.fsencode(path), AT_FDCWD, os.fsencode(other_path), RENAME_EXCHANGE) == 0
+
+_search_link_re = re.compile(r"\]\([^)]*\)")
+_search_apostrophe_re = re.compile(r"['’]")
+_search_token_re = re.compile(r"[^\W_]+")
+def search_tokens(text):
+    """Split text into a list of lowercase tokens for searching, ignoring punctuation, accents and Markdown markup.
+
+    E.g. "Don't _Stop_ Believin'" -> ["dont", "stop", "believin"].  Link targets in Markdown links are left out.
+    """
+    text = _search_apostrophe_re.sub("", _search_link_re.sub("]", text.casefold()))
+    decomposed = unicodedata.normalize('NFKD', text)
+    if not decomposed.isascii():
+        decomposed = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return _search_token_re.findall(decomposed)
+
+def search_shard_name(prefix):
+    """Return the file name for the search index shard of tokens starting with prefix."""
+    if re.fullmatch(r"[a-z0-9]+", prefix):
+        return prefix + ".json"
+    return "_" + prefix.encode("utf-8").hex() + ".json"
+
+def build_search_index(songs):
+    """Build an inverted index of the search_tokens of a list of songs, split into shards by the tokens' prefixes.
+
+    Returns a dict mapping each prefix (the first SEARCH_PREFIX_LENGTH characters of a token) to a dict mapping
+    the tokens with that prefix to their posting lists: the sorted slugs of the songs containing them.  Songs are
+    identified by slug rather than by their position in the list, so that adding, removing or retitling a song only
+    changes the shards of its own tokens.
+    """
+    postings = collections.defaultdict(list)
+    for song in sorted(songs, key=lambda song: song.slug):
+        for token in song.search_tokens:
+            postings[token].append(song.slug)
+    shards = collections.defaultdict(dict)
+    for token, slugs in postings.items():
+        shards[token[:SEARCH_PREFIX_LENGTH]][token] = slugs
+    return shards
+
+def precompression_encoders():
+    """Return a list of (suffix, encoding, compress function) tuples for the available compressed file formats."""
+    encoders = [(".gz", "gzip", lambda data: gzip.compress(data, compresslevel=9, mtime=0))]
+    try:
+        import brotli
+        encoders.append((".br", "br", lambda data: brotli.compress(data, mode=brotli.MODE_TEXT)))
+    except ImportError:
+        logging.debug("The brotli module isn't installed, so only precompressing with gzip.")
+    return encoders
+
+def precompress_file(path, encoders):
+    """Write compressed copies of the file at path, unless already up to date, using the results of precompression_encoders.
+
+    Returns a list of (suffix, whether it was written) tuples for the compressed copies.  Small files aren't compressed.
+    """
+    stat = os.stat(path)
+    if stat.st_size < MIN_PRECOMPRESS_SIZE:
+        return []
+    results = []
+    contents = None
+    for suffix, encoding, compress in encoders:
+        compressed_path = path + suffix
+        try:
+            written = os.stat(compressed_path).st_mtime_ns != stat.st_mtime_ns
+        except FileNotFoundError:
+            written = True
+        if written:
+            if contents is None:
+                with open(path, 'rb') as original_file:
+                    contents = original_file.read()
+            publish_file(compressed_path, compress(contents))
+            os.utime(compressed_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        results.append((suffix, written))
+    return results
+
+def in_path(path, parent):
+    """Return whether path is within the directory parent."""
+    return not os.path.relpath(path, parent).startswith(os.path.pardir+os.path.sep)
+
+def uses_template(dependencies, page_template, template_name):
+    """Return whether rendering page_template uses template_name, given the result of SiteBuilder.template_dependencies."""
+    if page_template not in dependencies:
+        return page_template == template_name
+    return dependencies[page_template] is None or template_name in dependencies[page_template]
+
+def site_url(output_path, filename="index.html"):
+    """Return the URL (relative to the root of the site) of a page rendered to filename in output_path."""
+    url = posixpath.sep + (output_path + posixpath.sep if output_path else "")
+    return url + filename if filename != "index.html" else url
+
+def datetimeformat(value, format='%B %d, %Y, %-I:%M %p'):
+    """A template filter for formatting datetimes."""
+    return value.strftime(format)
+
+def template_sources(templates_path):
+    """Return a dict mapping the name of each template in the directory at templates_path to the SHA-1 digest of its
+    source."""
+    import jinja2
+    sources = {}
+    for template_name in jinja2.FileSystemLoader(templates_path).list_templates():
+        with open(os.path.join(templates_path, *template_name.split(posixpath.sep)), 'rb') as template_file:
+            sources[template_name] = hashlib.sha1(template_file.read()).hexdigest()
+    return sources
+
+def compile_templates(templates_path, path):
+    """Compile all the templates in the directory at templates_path into Python modules in the directory at path,
+    returning the number compiled.
+
+    The modules can be loaded with a jinja2.ModuleLoader (see SiteBuilder.template_environment), saving each build
+    from compiling the templates.  The digests of the templates' sources are written alongside them, so out of date
+    modules aren't used.
+    """
+    import jinja2
+    os.makedirs(path, exist_ok=True)
+    for filename in os.listdir(path):
+        if filename.startswith("tmpl_") and filename.endswith(".py"):
+            os.remove(os.path.join(path, filename)) # Any left from since removed templates.
+    templates = jinja2.Environment(loader=jinja2.FileSystemLoader(templates_path))
+    templates.filters['datetimeformat'] = datetimeformat
+    sources = template_sources(templates_path)
+    try:
+        templates.compile_templates(path, zip=None, ignore_errors=False)
+    except jinja2.exceptions.TemplateSyntaxError as exception:
+        exception.translated = False
+        logging.error("Error compiling template '{0}':\n  {1}".format(exception.name, exception))
+        sys.exit(os.EX_DATAERR)
+    publish_file(os.path.join(path, COMPILED_TEMPLATES_MANIFEST),
+                 json.dumps(sources, indent=2, sort_keys=True).encode("utf-8"))
+    return len(sources)
+
+def configure_logging(log_level):
+    logging.basicConfig(level=log_level, format=LOG_FORMAT)
+    logging.getLogger('MARKDOWN').setLevel(logging.WARNING)
+
+def parallel_map(function, items, jobs, chunksize=1, initializer=None, initargs=(), start_method=None, cancelled=None):
+    """Return a list of function applied to each of items, using a pool of jobs worker processes if jobs > 1.
+
+    function must be picklable (i.e. defined at module level), as must items and results.
+    initializer (if given) is called with initargs once in each worker process (or once in this one if not using a pool).
+    start_method is an optional multiprocessing start method, used if available on this platform, e.g. "fork" to have
+    workers inherit (rather than unpickle) large initargs.
+    If cancelled is given, it's called after each result, and RebuildCancelled is raised if it returns True.
+    """
+    items = list(items)
+    results = []
+    if jobs <= 1 or len(items) <= 1:
+        if initializer:
+            initializer(*initargs)
+        for item in items:
+            if cancelled and cancelled():
+                raise RebuildCancelled()
+            results.append(function(item))
+        return results
+    import multiprocessing
+    context = None
+    if start_method in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context(start_method)
+    worker_initargs = (logging.getLogger().getEffectiveLevel(), initializer, initargs)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(items)), mp_context=context,
+                                                initializer=_initialize_worker, initargs=worker_initargs) as pool:
+        try:
+            for result in pool.map(function, items, chunksize=chunksize):
+                if cancelled and cancelled():
+                    raise RebuildCancelled()
+                results.append(result)
+            return results
+        except BaseException:
+            pool.shutdown(cancel_futures=True) # Don't bother with the rest after an error (e.g. in a template).
+            raise
+
+def _initialize_worker(log_level, initializer, initargs):
+    """Set up a worker process for parallel_map (logging config isn't inherited when processes are spawned)."""
+    configure_logging(log_level)
+    if initializer:
+        initializer(*initargs)
+
+
+# Lyrics which only use paragraphs, line breaks, emphasis and apostrophes are rendered by render_simple_lyrics, and
+# anything which could mean something more to Markdown (or its extensions) is left to Markdown: HTML, entities,
+# escapes, code, links, headings, lists, block quotes, indented or trailing spaces, quotes, dashes and ellipses.
+_simple_lyrics_unsafe_re = re.compile(r"[\\`<>&\"\[\]#\x00-\x09\x0b-\x1f]|--|\.\.|^(?:[*+-] |\d+\.(?: |$)|[=-]+$|[^\S\n])|[^\S\n]$",
+                                      re.MULTILINE)
+_simple_lyrics_emphasis_re = re.compile(r"\*\*([^*_\s](?:[^*_]*[^*_\s])?)\*\*|\*([^*_\s](?:[^*_]*[^*_\s])?)\*|"
+                                        r"(?<!\w)__([^*_\s](?:[^*_]*[^*_\s])?)__(?!\w)|(?<!\w)_([^*_\s](?:[^*_]*[^*_\s])?)_(?!\w)")
+# As smarty renders them: closing after a letter (unless followed by a digit), and opening after a space (or at the
+# start of a line) before a letter (except "'s", which smarty closes at the start of a line).
+_simple_lyrics_closing_quote_re = re.compile(r"(?<=[A-Za-z])'(?!\d)")
+_simple_lyrics_opening_quote_re = re.compile(r"(?:^|(?<= ))'(?=[A-Za-z])(?!s\b)", re.MULTILINE)
+_simple_lyrics_emphasis_tags = ("strong", "em", "strong", "em")
+
+def render_simple_lyrics(text):
+    """Render lyrics written in a simple subset of Markdown into HTML, or return None if they use anything else.
+
+    The subset is paragraphs, line breaks, **strong** and _emphasised_ (or __strong__ and *emphasised*) text which
+    doesn't nest or cross lines, and apostrophes, giving exactly the same HTML as Song.markdown would (with the nl2br
+    and smarty extensions), but much faster.
+    """
+    if _simple_lyrics_unsafe_re.search(text):
+        return None
+    text = _simple_lyrics_closing_quote_re.sub("&rsquo;", text)
+    text = _simple_lyrics_opening_quote_re.sub("&lsquo;", text)
+    if "'" in text:
+        return None
+    def emphasis(match):
+        index = match.lastindex - 1
+        return "<%s>%s</%s>" % (_simple_lyrics_emphasis_tags[index], match.group(match.lastindex), _simple_lyrics_emphasis_tags[index])
+    paragraphs = []
+    for paragraph in re.split(r"\n\n+", text):
+        lines = []
+        for line in paragraph.split("\n"):
+            line = _simple_lyrics_emphasis_re.sub(emphasis, line)
+            if "*" in line or "_" in line:
+                return None
+            lines.append(line)
+        paragraphs.append("<p>%s</p>" % "<br>\n".join(lines))
+    return "\n".join(paragraphs) if text else ""
+
+_shared_markdown = None
+@functools.lru_cache(maxsize=LYRICS_CACHE_SIZE)
+def render_lyrics(text):
+    """Render lyrics from Markdown into HTML, with single line breaks kept as <br> tags and smart punctuation.
+
+    Lyrics in the subset handled by render_simple_lyrics skip Markdown altogether.  Results are memoized, so the
+    same lyrics (e.g. a song in more than one file, or reloaded in low memory mode) are only rendered once.
+    """
+    global _shared_markdown
+    html = render_simple_lyrics(text)
+    if html is not None:
+        return html
+    if not _shared_markdown:
+        import markdown
+        _shared_markdown = markdown.Markdown(extensions=["markdown.extensions.nl2br", "markdown.extensions.smarty"],
+                                             output_format = "html5")
+    return _shared_markdown.reset().convert(text)
+
 
 class Song:
-    """A song with associated metadata."""
+    """A song with associated metadata.
+
+    Songs use __slots__ and keep the tags parsed from their file only in self.tags, to keep their memory use down in
+    large songbooks.  Their lyrics are only rendered to HTML (and their first line found) when first used.  Songs
+    loaded by a low_memory SongBook don't keep their lyrics at all (raw_lyrics is None), but read them again from
+    their file (with self._lyrics_loader) each time they're used.
+    """
+    __slots__ = ("filename", "title", "tags", "raw_lyrics", "_lyrics", "_first_line", "_search_tokens", "_slug",
+                 "_uniquing_string", "url", "see", "categories", "_lyrics_loader")
 
     def __init__(self, tags, lyrics, filename=None):
         """Create a Song object given a list of tags and the lyrics.
@@ -66,8 +523,12 @@ class Song:
         filename: Optional, to be used in debugging messages, for missing titles, etc.
         """
         debugging_filename = filename if filename != None else "<no file>"
+        self.filename = filename
         self.raw_lyrics = lyrics
-        self.lyrics = self.markdown(lyrics)
+        self._lyrics = None
+        self._first_line = None
+        self._search_tokens = None
+        self._lyrics_loader = None
         self.tags = {}
         single_tags = set(["copyright", "source", "title", "tune"])
         array_tags = set(["aka", "see", "tags"])
@@ -87,16 +548,18 @@ class Song:
             self.title = self.tags["title"]
         else:
             if filename:
-                self.title = filename.replace("_", " ")
+                self.title = os.path.basename(filename).replace("_", " ")
                 if self.title.endswith(SONG_EXTENSION):
                     self.title = self.title[:-len(SONG_EXTENSION)]
             else:
                 self.title = "Unknown"
             logging.warning("No title found in file \"%s\".  Falling back on \"%s\"." % (debugging_filename, self.title))
-        self.copyright = self.tags.get("copyright", None)
-        self.source = self.tags.get("source", None)
-        self.tune = self.tags.get("tune", None)
-        self.aka = self.tags.get("aka", [])
+        self._init_links()
+
+    def _init_links(self):
+        self._slug = None
+        self._uniquing_string = ""
+        self.url = None
         self.see = []
         self.categories = []
 
@@ -113,6 +576,11 @@ class Song:
         of the lyrics can always be triggered by a blank line, even if the
         first line of the lyrics would otherwise be parsed as a tag.
         """
+        return cls(*cls.split_file(file_contents), filename)
+
+    @staticmethod
+    def split_file(file_contents):
+        """Split the contents of a song file into a list of (tag, value) tuples and the lyrics (see from_string)."""
         lines = file_contents.splitlines()
         tags = []
         for index, line in enumerate(lines):
@@ -123,14 +591,32 @@ class Song:
             value = parts[1].strip()
             tags.append((tag, value))
         body = "\n".join(lines[index:]).strip('\n')
-        return cls(tags, body, filename)
+        return tags, body
+
+    def to_record(self):
+        """Return the parsed contents of the song as a tuple of plain values, suitable for pickling.
+
+        Only what was parsed from the song file is included, not the links to other songs or categories.  The lyrics
+        are rendered (and first line found), if they haven't been already, so they needn't be again.
+        """
+        return (self.filename, self.title, self.tags, self.raw_lyrics, self.lyrics, self.first_line)
+
+    def to_metadata_record(self):
+        """Return a record like to_record, but without the lyrics (raw or rendered), for a low_memory SongBook."""
+        return (self.filename, self.title, self.tags, None, None, self.first_line)
+
+    @classmethod
+    def from_record(cls, record):
+        """Recreate a Song from a tuple returned by to_record, without re-parsing or re-rendering its lyrics."""
+        song = cls.__new__(cls)
+        song.filename, song.title, song.tags, song.raw_lyrics, song._lyrics, song._first_line = record
+        song._search_tokens = None
+        song._lyrics_loader = None
+        song._init_links()
+        return song
 
-    _shared_markdown = None
     def markdown(self, text):
-        if not Song._shared_markdown:
-            Song._shared_markdown = markdown.Markdown(extensions=["markdown.extensions.nl2br", "markdown.extensions.smarty"],
-                                                      output_format = "html5")
-        return Song._shared_markdown.reset().convert(text)
+        return render_lyrics(text)
 
     def __str__(self):
         return "<Song \"%s\">" % self.title
@@ -138,31 +624,84 @@ class Song:
     def __repr__(self):
         return "<Song \"%s\" (%s)>" % (self.title, self.slug)
 
+    @property
+    def lyrics(self):
+        """The lyrics of the song, rendered from Markdown into HTML."""
+        if self._lyrics is None:
+            if self.raw_lyrics is None:
+                return self.markdown(self._lyrics_loader(self)) # Not kept, to save memory.
+            self._lyrics = self.markdown(self.raw_lyrics)
+        return self._lyrics
+
+    @property
+    def copyright(self):
+        return self.tags.get("copyright", None)
+
+    @property
+    def source(self):
+        return self.tags.get("source", None)
+
+    @property
+    def tune(self):
+        return self.tags.get("tune", None)
+
+    @property
+    def aka(self):
+        return self.tags.get("aka", [])
+
+    @property
+    def uniquing_string(self):
+        """A suffix added to the song's slug to make it unique, if multiple songs' titles have the same slug."""
+        return self._uniquing_string
+
+    @uniquing_string.setter
+    def uniquing_string(self, uniquing_string):
+        self._uniquing_string = uniquing_string
+        self._slug = None
+
     @property
     def slug(self):
-        return slugify(self.title) + getattr(self, "uniquing_string", "")
+        if self._slug is None:
+            self._slug = slugify(self.title) + self._uniquing_string
+        return self._slug
 
     __bold_re = re.compile(r"(?:\*\*(.+?)\*\*)|(?:__(.+?)__)")
     __italic_re = re.compile(r"(?:\*(.+?)\*)|(?:_(.+?)_)")
     __unicode_alphanum_re = re.compile(r"\w", re.UNICODE)
     @property
     def first_line(self):
-        try:
-            return self._first_line
-        except:
+        if self._first_line is None:
+            self._first_line = "[%s]" % self.title
             for line in self.raw_lyrics.splitlines():
                 line = Song.__bold_re.sub("", line)
                 line = self.__italic_re.sub("", line)
                 line = line.strip()
                 if Song.__unicode_alphanum_re.search(line):
-                    return line
-        return "[%s]" % self.title
+                    self._first_line = line
+                    break
+        return self._first_line
+
+    @property
+    def search_tokens(self):
+        """The set of search_tokens in the song's title, AKA titles, first line, and lyrics (as plain text)."""
+        if self._search_tokens is None:
+            raw_lyrics = self.raw_lyrics if self.raw_lyrics is not None else self._lyrics_loader(self)
+            text = "\n".join([self.title] + self.aka + [self.first_line, raw_lyrics])
+            tokens = frozenset(search_tokens(text))
+            if self.raw_lyrics is None:
+                return tokens # Not kept, to save memory.
+            self._search_tokens = tokens
+        return self._search_tokens
 
 
 class Category:
+    __slots__ = ("name", "songs", "_slug", "url")
+
     def __init__(self, name):
         self.name = name
         self.songs = []
+        self._slug = None
+        self.url = None
 
     def __str__(self):
         return "<Category \"%s\">" % self.name
@@ -172,23 +711,597 @@ class Category:
 
     @property
     def slug(self):
-        return slugify(self.name)
+        if self._slug is None:
+            self._slug = slugify(self.name)
+        return self._slug
+
+
+class Page:
+    """One page of a listing of songs or categories split into several pages (see SiteBuilder.paginate).
+
+    number counts from 1, and label is the page's number, or its initial letter (or "#" for anything else) if split
+    by letter.  The pages of a listing are all in the same directory, the first as index.html, so href is the page's
+    address relative to the others.
+    """
+    __slots__ = ("number", "label", "items", "filename", "href")
+
+    def __init__(self, number, label, items, filename):
+        self.number = number
+        self.label = label
+        self.items = items
+        self.filename = filename
+        self.href = "./" if filename == "index.html" else filename
+
+    def __repr__(self):
+        return "<Page %s (%d items)>" % (self.label, len(self.items))
+
+
+def initial_letter(text):
+    """Return the (lowercase, unaccented) first letter of text, or "#" if it doesn't start with a letter."""
+    letter = slugify(text)[:1]
+    return letter if "a" <= letter <= "z" else "#"
+
+
+def matches_pattern(rel_path, patterns):
+    """Return whether a relative path matches any of a list of fnmatch-style patterns (matched against "/"-separated paths)."""
+    rel_path = rel_path.replace(os.path.sep, posixpath.sep)
+    return any(fnmatch.fnmatchcase(rel_path, pattern) for pattern in patterns)
+
+def discover_song_files(path, include=SONG_PATTERNS, exclude=(), subdirectory=""):
+    """Return a list of (path, relative path) tuples of the song files in the directory at path and its subdirectories.
+
+    Files (and directories) are found with os.scandir, so their types are usually known without a stat of each.
+    Files must match one of the include patterns (see matches_pattern) to be included, and files and directories
+    matching any of the exclude patterns, or whose names start with ".", are left out.  Symbolic links to directories
+    aren't followed.  The list is sorted by relative path, so it doesn't depend on the order of directory entries.
+    If subdirectory is given (relative to path), only the files within it are returned.
+    """
+    song_files = []
+    directories = [subdirectory]
+    while directories:
+        rel_dir = directories.pop()
+        with os.scandir(os.path.join(path, rel_dir)) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                rel_path = os.path.join(rel_dir, entry.name)
+                if matches_pattern(rel_path, exclude):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(rel_path)
+                elif entry.is_file() and matches_pattern(rel_path, include):
+                    song_files.append((entry.path, rel_path))
+    song_files.sort(key=lambda song_file: song_file[1])
+    return song_files
+
+def threaded_map(function, items, threads):
+    """Yield function applied to each of items, in order, calling it on up to threads threads at once.
+
+    Meant for overlapping I/O (e.g. reading files from network storage).  Only a limited number of results are
+    computed ahead of those yielded, so they needn't all be held in memory at once.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        pending = collections.deque()
+        for item in items:
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().result()
+            pending.append(pool.submit(function, item))
+        while pending:
+            yield pending.popleft().result()
+
+def read_song_file(filepath):
+    """Return a tuple of the stat and the contents (as bytes) of a song file."""
+    with open(filepath, 'rb') as song_file:
+        return os.fstat(song_file.fileno()), song_file.read()
+
+def decode_song(contents, filename, encoding=SONG_ENCODING):
+    """Decode the contents of a song file, dropping any byte order mark.
+
+    Anything that isn't valid in the encoding is replaced (with a warning), rather than failing the whole build.
+    """
+    try:
+        text = contents.decode(encoding)
+    except UnicodeDecodeError as error:
+        logging.warning("Song file \"%s\" isn't valid %s (%s at byte %d); replacing the invalid characters."
+                        % (filename, encoding, error.reason, error.start))
+        text = contents.decode(encoding, errors="replace")
+    return text[1:] if text.startswith("\ufeff") else text
+
+def parse_song_contents(job, stat, contents, metadata_only=False):
+    """Parse the contents of a song file, given a job tuple (as for parse_song_file) and the file's stat and contents.
+
+    Returns a tuple of the file's stat, the digest of its contents, the parsed Song's record (see Song.to_record, or
+    Song.to_metadata_record if metadata_only is set), or None instead of a record if the contents match the cached
+    digest, and the wall and CPU time taken rendering its lyrics from Markdown (or None).
+    """
+    filepath, filename, cached_digest, encoding = job
+    digest = hashlib.sha1(contents).hexdigest()
+    if digest == cached_digest:
+        return stat, digest, None, None
+    song = Song.from_string(decode_song(contents, filename, encoding), filename=filename)
+    if metadata_only:
+        return stat, digest, song.to_metadata_record(), None
+    start, start_cpu = time.perf_counter(), time.process_time()
+    song.lyrics
+    markdown_time = (time.perf_counter() - start, time.process_time() - start_cpu)
+    return stat, digest, song.to_record(), markdown_time
+
+def parse_song_file(job):
+    """Read and parse a song file, given a tuple of its path, its filename, the digest of any cached version of it,
+    and its encoding, returning a tuple as from parse_song_contents.
+
+    Defined at the module level (and taking a single tuple) to be usable with parallel_map.
+    """
+    return parse_song_contents(job, *read_song_file(job[0]))
+
+def parse_song_metadata(job):
+    """Like parse_song_file, but returning a record from Song.to_metadata_record, for a low_memory SongBook."""
+    return parse_song_contents(job, *read_song_file(job[0]), metadata_only=True)
+
+def parse_archived_song(job):
+    """Parse a song from a SongArchive, given a tuple of its filename, its contents (as from SongArchive.songs) and
+    whether to only return its metadata, returning a tuple as from parse_song_contents (with no stat)."""
+    filename, contents, metadata_only = job
+    return parse_song_contents((None, filename, None, SONG_ENCODING), None, contents, metadata_only=metadata_only)
+
+
+def archive_filename(name):
+    """Return the relative path of a song in a SongArchive, given its "/"-separated filename there, or None if it isn't
+    a valid relative path (e.g. it's absolute, or contains "..")."""
+    parts = name.split(posixpath.sep)
+    if any(part in ("", os.path.curdir, os.path.pardir) for part in parts):
+        return None
+    return os.path.join(*parts)
+
+def export_songs(songs_path, archive_path, include=SONG_PATTERNS, exclude=(), encoding=SONG_ENCODING,
+                 read_threads=READ_THREADS):
+    """Write all the song files in songs_path (see discover_song_files) into a new SongArchive at archive_path,
+    returning the number of songs written.
+
+    The song files are decoded from encoding (the archive is always in SONG_ENCODING), and read by up to read_threads
+    threads at once.
+    """
+    song_files = discover_song_files(songs_path, include, exclude)
+    files = threaded_map(read_song_file, [filepath for filepath, filename in song_files], read_threads)
+    return SongArchive(archive_path).write((filename, decode_song(contents, filename, encoding))
+                                           for (filepath, filename), (stat, contents) in zip(song_files, files))
+
+def import_songs(archive_path, songs_path, encoding=SONG_ENCODING):
+    """Write each song in the SongArchive at archive_path to a song file in songs_path, encoded with encoding.
+
+    Directories are created as needed.  Files which already have the same contents aren't rewritten, and other files
+    in songs_path are left alone.  Returns the number of songs in the archive and the number of files written.
+    """
+    count = written = 0
+    for filename, contents in SongArchive(archive_path).songs():
+        text = decode_song(contents, filename)
+        try:
+            contents = text.encode(encoding)
+        except UnicodeEncodeError as error:
+            logging.warning("Song \"%s\" can't be written in %s (%s at character %d); replacing the characters which can't."
+                            % (filename, encoding, error.reason, error.start))
+            contents = text.encode(encoding, errors="replace")
+        path = os.path.join(songs_path, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        count += 1
+        if publish_file(path, contents):
+            written += 1
+    return count, written
+
+
+class SongArchiveError(Exception):
+    """Raised when a song archive can't be read or written at all (rather than just some of the songs in it)."""
+
+
+class SongArchive:
+    """A single file holding the contents of many song files, as an alternative to a directory of them.
+
+    Syncing, checking out and opening a file per song is slow for large songbooks (especially on network or container
+    filesystems), so the songs can be kept in one file instead: either a SQLite database with a "songs" table of
+    "filename" and "text" columns, or a JSON Lines file with an object with "filename" and "text" keys on each line.
+    Each song's text is exactly what its song file would contain (in SONG_ENCODING, if stored as bytes), and its
+    filename is its path relative to the songs directory, with "/" separators.  The format is chosen by the file's
+    extension (see SONG_ARCHIVE_FORMATS).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.format = SONG_ARCHIVE_FORMATS.get(os.path.splitext(path)[1].lower())
+        if not self.format:
+            raise SongArchiveError("Song archive \"%s\" isn't a known format (its name should end with one of: %s)"
+                                   % (path, ", ".join(SONG_ARCHIVE_FORMATS)))
+        self.offsets = {} # Filename: offset of its line in a JSON Lines archive, as of the last read, for reading it again.
+
+    def songs(self):
+        """Yield a (filename, contents) tuple for each song in the archive, reading them one at a time.
+
+        Filenames are relative paths (with native separators), and contents are bytes, to be decoded with decode_song as
+        if read from a song file.  Invalid entries (e.g. with absolute filenames) are skipped with a warning, as are any
+        with the same filename as an earlier one.
+        """
+        offsets = {}
+        for name, text, offset in (self.sqlite_entries() if self.format == "sqlite" else self.jsonl_entries()):
+            filename = archive_filename(name) if isinstance(name, str) else None
+            if filename is None or not isinstance(text, (str, bytes)):
+                logging.warning("Skipping an invalid song (filename %r) in song archive \"%s\"" % (name, self.path))
+                continue
+            if filename in offsets:
+                logging.warning("Song archive \"%s\" contains \"%s\" more than once; skipping all but the first."
+                                % (self.path, name))
+                continue
+            offsets[filename] = offset
+            yield filename, self.encode(text)
+        self.offsets = offsets
+
+    def read(self, filename):
+        """Return the contents (as bytes) of a single song in the archive, given its filename (as from songs)."""
+        name = filename.replace(os.path.sep, posixpath.sep)
+        if self.format == "sqlite":
+            import sqlite3
+            try:
+                connection = self.connect()
+                try:
+                    row = connection.execute("SELECT text FROM songs WHERE filename = ?", (name,)).fetchone()
+                finally:
+                    connection.close()
+            except sqlite3.Error as error:
+                raise SongArchiveError("Couldn't read song archive \"%s\": %s" % (self.path, error))
+        else:
+            row = None
+            if filename in self.offsets:
+                try:
+                    with open(self.path, 'rb') as archive_file:
+                        archive_file.seek(self.offsets[filename])
+                        entry = json.loads(archive_file.readline())
+                        row = (entry["text"],) if entry["filename"] == name else None
+                except (OSError, ValueError, KeyError, TypeError) as error:
+                    raise SongArchiveError("Couldn't read \"%s\" from song archive \"%s\": %s" % (name, self.path, error))
+        if row is None or not isinstance(row[0], (str, bytes)):
+            raise SongArchiveError("Song archive \"%s\" no longer contains \"%s\"" % (self.path, name))
+        return self.encode(row[0])
+
+    @staticmethod
+    def encode(text):
+        # Any lone surrogates (from JSON escapes) are kept, to be replaced with a warning by decode_song.
+        return text if isinstance(text, bytes) else text.encode(SONG_ENCODING, errors="surrogatepass")
+
+    def connect(self):
+        """Return a new read-only connection to a SQLite archive."""
+        import sqlite3
+        import urllib.parse
+        # Opened by URI, so a missing archive is an error rather than a new, empty database.
+        return sqlite3.connect("file:%s?mode=ro" % urllib.parse.quote(os.path.abspath(self.path)), uri=True)
+
+    def sqlite_entries(self):
+        """Yield a (filename, text, None) tuple for each row of a SQLite archive, in order of filename."""
+        import sqlite3
+        try:
+            connection = self.connect()
+            try:
+                for name, text in connection.execute("SELECT filename, text FROM songs ORDER BY filename"):
+                    yield name, text, None
+            finally:
+                connection.close()
+        except sqlite3.Error as error:
+            raise SongArchiveError("Couldn't read song archive \"%s\": %s" % (self.path, error))
+
+    def jsonl_entries(self):
+        """Yield a (filename, text, offset) tuple for each line of a JSON Lines archive, in order."""
+        try:
+            with open(self.path, 'rb') as archive_file:
+                offset = 0
+                for line_number, line in enumerate(archive_file, 1):
+                    line_offset, offset = offset, offset + len(line)
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = json.loads(line)
+                        name, text = entry["filename"], entry["text"]
+                    except (ValueError, KeyError, TypeError) as error:
+                        logging.warning("Skipping line %d of song archive \"%s\", which isn't a valid song (%s)."
+                                        % (line_number, self.path, error))
+                        continue
+                    yield name, text, line_offset
+        except OSError as error:
+            raise SongArchiveError("Couldn't read song archive \"%s\": %s" % (self.path, error))
+
+    def write(self, songs):
+        """Replace the contents of the archive with songs, an iterable of (filename, text) tuples, returning the number
+        of songs written.
+
+        The songs are written as they're taken from songs (e.g. a generator), to a temporary file which then replaces
+        the archive, so a partially written archive is never visible at its path.
+        """
+        songs = ((filename.replace(os.path.sep, posixpath.sep), text) for filename, text in songs)
+        temp_path = temporary_path(self.path)
+        try:
+            if self.format == "sqlite":
+                import sqlite3
+                try:
+                    connection = sqlite3.connect(temp_path)
+                    try:
+                        connection.execute("CREATE TABLE songs (filename TEXT PRIMARY KEY, text TEXT NOT NULL)")
+                        count = connection.executemany("INSERT INTO songs VALUES (?, ?)", songs).rowcount
+                        connection.commit()
+                    finally:
+                        connection.close()
+                except sqlite3.Error as error:
+                    raise SongArchiveError("Couldn't write song archive \"%s\": %s" % (self.path, error))
+            else:
+                count = 0
+                with open(temp_path, 'w', encoding=SONG_ENCODING, newline="\n") as archive_file:
+                    for filename, text in songs:
+                        archive_file.write(json.dumps({"filename": filename, "text": text}, ensure_ascii=False) + "\n")
+                        count += 1
+            os.replace(temp_path, self.path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return count
+
+
+def package_fingerprint(name):
+    """Return a string identifying the installed copy of a package (its location and when it was installed), without
+    importing it, or None if it isn't installed."""
+    spec = importlib.util.find_spec(name)
+    if spec is None or not spec.origin:
+        return None
+    stat = os.stat(spec.origin)
+    return "%s-%x-%x" % (spec.origin, stat.st_mtime_ns, stat.st_size)
+
+
+class ParseCache:
+    """An on-disk cache of parsed songs, so unchanged song files aren't re-parsed (and re-rendered) on every build.
+
+    Entries are keyed by the song's filename, and are reused if the file's size and modification time are unchanged,
+    or failing that (e.g. after a fresh checkout), if the hash of its contents is unchanged.  The whole cache is
+    invalidated if it was written by a different CACHE_FORMAT_VERSION or installation of Markdown (see
+    package_fingerprint, which avoids importing Markdown when every song is cached), or for song files decoded with
+    a different encoding.
+    """
+    def __init__(self, cache_dir, rebuild=False, encoding=SONG_ENCODING):
+        """Load the cache stored in cache_dir, if any.  If rebuild is set, any existing cache is ignored (and replaced)."""
+        self.path = os.path.join(cache_dir, "songs.pickle")
+        self.header = (CACHE_FORMAT_VERSION, package_fingerprint("markdown"), encoding)
+        self.entries = {}
+        self.changed = rebuild
+        self.saved_time = None # time.monotonic() when the cache was last written.
+        self.hits = 0
+        self.misses = 0
+        if not rebuild:
+            self.load()
+
+    def load(self):
+        import pickle
+        try:
+            with open(self.path, 'rb') as cache_file:
+                header, entries = pickle.load(cache_file)
+        except FileNotFoundError:
+            logging.debug("No song cache found at \"%s\"." % self.path)
+            return
+        except Exception as error:
+            logging.warning("Ignoring unreadable song cache \"%s\": %s" % (self.path, error))
+            self.changed = True
+            return
+        if header != self.header:
+            logging.info("Song cache \"%s\" is from a different version, rebuilding it." % self.path)
+            self.changed = True
+            return
+        self.entries = entries
+
+    def save(self, prune=False, min_interval=0):
+        """Write the cache to disk if anything changed.  If prune is set, only entries used since it was loaded are kept.
+
+        If the cache was written less than min_interval seconds ago, it isn't written yet (e.g. so that a stream of
+        edits while watching doesn't rewrite the whole cache each time); the changes are kept until the next save.
+        """
+        used = {filename: entry for filename, entry in self.entries.items() if entry[-1] or not prune}
+        if not self.changed and len(used) == len(self.entries):
+            return
+        if self.saved_time is not None and time.monotonic() - self.saved_time < min_interval:
+            return
+        import pickle
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = temporary_path(self.path)
+        with open(temp_path, 'wb') as cache_file:
+            pickle.dump((self.header, {filename: entry[:-1] + (False,) for filename, entry in used.items()}),
+                        cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self.path)
+        self.entries = used
+        self.changed = False
+        self.saved_time = time.monotonic()
+
+    def lookup(self, filename, stat, digest=None):
+        """Return the cached record for filename if it's still valid for a file with the given stat (or content digest).
+
+        stat is None for songs which aren't in files of their own (see SongArchive), which only match by digest.
+        """
+        entry = self.entries.get(filename)
+        if entry is None:
+            return None
+        size, mtime, entry_digest, record, used = entry
+        key = (stat.st_size, stat.st_mtime_ns) if stat else (None, None)
+        if stat and (size, mtime) == key:
+            pass
+        elif digest is not None and digest == entry_digest:
+            self.changed = self.changed or (size, mtime) != key
+        else:
+            return None
+        self.entries[filename] = key + (entry_digest, record, True)
+        self.hits += 1
+        return record
+
+    def digest(self, filename):
+        """Return the content digest of the cached entry for filename, or None if there is no such entry."""
+        entry = self.entries.get(filename)
+        return entry[2] if entry else None
+
+    def discard(self, filename):
+        if self.entries.pop(filename, None):
+            self.changed = True
+
+    def store(self, filename, stat, digest, record):
+        key = (stat.st_size, stat.st_mtime_ns) if stat else (None, None)
+        self.entries[filename] = key + (digest, record, True)
+        self.changed = True
+        self.misses += 1
+
+
+class BuildProfile:
+    """Records the time taken by each phase of a build, and other statistics about it, for --profile.
+
+    Phases are timed with the phase context manager; those started during another phase are recorded as part of it
+    (named e.g. "rendering/writing").  Time spent in worker processes is recorded there in a BuildProfile of their own
+    and merged in from its stats(), so sub-phases run in parallel may add up to more wall time than their phase.
+    Each phase started outside any other is also run under cProfile if profile_code is set, so the hottest can be
+    dumped with dump_hottest_phase, and if on_phase is given, it's called with the phase's name once it ends (e.g. to
+    measure the memory used by then).
+    """
+    def __init__(self, profile_code=False, on_phase=None):
+        self.phases = collections.OrderedDict() # Phase name: [wall time, CPU time, times run]
+        self.templates = collections.defaultdict(list) # Template name: list of render times
+        self.counters = collections.Counter()
+        self.profile_code = profile_code
+        self.on_phase = on_phase
+        self.code_profiles = {}
+        self.current = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the code run within the context as the phase name (within the current phase, if any)."""
+        code_profile = None
+        if self.profile_code and not self.current:
+            import cProfile
+            code_profile = self.code_profiles.setdefault(name, cProfile.Profile())
+            code_profile.enable()
+        self.phases.setdefault(posixpath.join(*self.current, name), [0, 0, 0]) # Listed before any sub-phases.
+        self.current.append(name)
+        start, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - start, time.process_time() - start_cpu
+            self.current.pop()
+            self.add(name, wall, cpu)
+            if code_profile:
+                code_profile.disable()
+            if self.on_phase and not self.current:
+                self.on_phase(name)
+
+    def reset(self):
+        """Forget everything recorded so far (e.g. before each rebuild while watching)."""
+        self.phases.clear()
+        self.templates.clear()
+        self.counters.clear()
+        self.code_profiles.clear()
+
+    def add(self, name, wall, cpu, runs=1):
+        """Add time measured elsewhere (e.g. in a worker process) to the phase name, within the current phase."""
+        entry = self.phases.setdefault(posixpath.join(*self.current, name), [0, 0, 0])
+        entry[0] += wall
+        entry[1] += cpu
+        entry[2] += runs
+
+    def add_template(self, template_name, wall):
+        self.templates[template_name].append(wall)
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def stats(self):
+        """Return the recorded statistics as plain values, e.g. to be returned from a worker process and merged."""
+        return dict(self.phases), dict(self.templates), dict(self.counters)
+
+    def merge(self, stats):
+        """Add statistics from another BuildProfile's stats() into this one, within the current phase."""
+        phases, templates, counters = stats
+        for name, (wall, cpu, runs) in phases.items():
+            self.add(name, wall, cpu, runs)
+        for template_name, times in templates.items():
+            self.templates[template_name].extend(times)
+        self.counters.update(counters)
+
+    def report(self):
+        """Return a dict of the recorded statistics, with percentiles of the render times of each template."""
+        def percentile(times, fraction):
+            return times[min(len(times) - 1, int(fraction * len(times)))]
+        templates = {}
+        for template_name, times in sorted(self.templates.items()):
+            times = sorted(times)
+            templates[template_name] = {"count": len(times), "total": sum(times),
+                                        "p50": percentile(times, 0.5), "p99": percentile(times, 0.99)}
+        return {"phases": {name: {"wall": wall, "cpu": cpu, "runs": runs} for name, (wall, cpu, runs) in self.phases.items()},
+                "templates": templates, "counters": dict(sorted(self.counters.items()))}
+
+    def format_report(self):
+        """Return the recorded statistics as text, for printing to the console."""
+        report = self.report()
+        lines = ["%-28s %10s %10s %8s" % ("Phase", "Wall (s)", "CPU (s)", "Runs")]
+        for name, phase in report["phases"].items():
+            depth = name.count(posixpath.sep)
+            label = "  " * depth + posixpath.basename(name)
+            lines.append("%-28s %10.3f %10.3f %8d" % (label, phase["wall"], phase["cpu"], phase["runs"]))
+        if report["templates"]:
+            lines.append("")
+            lines.append("%-28s %8s %10s %10s %10s" % ("Template", "Count", "Total (s)", "p50 (ms)", "p99 (ms)"))
+            for template_name, template in report["templates"].items():
+                lines.append("%-28s %8d %10.3f %10.3f %10.3f" % (truncate(template_name, 28), template["count"],
+                             template["total"], template["p50"] * 1000, template["p99"] * 1000))
+        if report["counters"]:
+            lines.append("")
+            lines.extend("%-28s %10d" % (name.replace("_", " ").capitalize(), value)
+                         for name, value in report["counters"].items())
+        return "\n".join(lines)
+
+    def hottest_phase(self):
+        """Return the name of the (outermost) phase which took the most wall time, or None if none were timed."""
+        outer_phases = [(wall, name) for name, (wall, cpu, runs) in self.phases.items() if posixpath.sep not in name]
+        return max(outer_phases)[1] if outer_phases else None
+
+    def dump_hottest_phase(self, path):
+        """Write the cProfile stats of the hottest phase to path (for use with pstats), returning the phase's name."""
+        name = self.hottest_phase()
+        if name in self.code_profiles:
+            self.code_profiles[name].dump_stats(path)
+            return name
+        return None
 
 
 class SongBook:
     """A collection of songs, linked by their associated categories and cross references."""
-    def __init__(self, songs_path):
+    def __init__(self, songs_path, cache=None, jobs=1, profile=None, low_memory=False, include=SONG_PATTERNS, exclude=(),
+                 encoding=SONG_ENCODING, read_threads=READ_THREADS, archive=None):
         """Load all song files and templates from source_path.
         
         Song objects are created for all loaded songs, as well as Category objects for any tags they specify.
-        The resulting Song and Category objects will then reference each other as appropriate."""
-        self.songs = self.songs_from_directory(songs_path)
-        logging.info("Parsed %d songs", len(self.songs))
-        self.link_songs_and_categories()
-        self.songs.sort(key=lambda song: song.title.lower())
-        self.categories.sort(key=lambda cat: cat.name.lower())
-        for categories in self.categories:
-            categories.songs.sort(key=lambda song: song.title.lower())
+        The resulting Song and Category objects will then reference each other as appropriate.
+        If a ParseCache is given, it's used to skip parsing any song files which haven't changed since it was saved.
+        Song files are parsed using up to jobs worker processes.  The time taken is recorded in profile, if given.
+        If low_memory is set, only the songs' metadata is kept in memory (and no cache can be used), and their
+        lyrics are read from their files again whenever needed (see read_lyrics).
+        Song files are found in songs_path and its subdirectories according to the include and exclude patterns
+        (see discover_song_files), are decoded with encoding, and are read by up to read_threads threads at once
+        (when not using worker processes).
+        If a SongArchive is given, the songs are loaded from it instead of from songs_path (see songs_from_archive)."""
+        self.songs_path = songs_path
+        self.low_memory = low_memory
+        self.include = include
+        self.exclude = exclude
+        self.encoding = encoding
+        self.read_threads = read_threads
+        self.cache = cache if not low_memory else None
+        self.jobs = jobs
+        self.profile = profile if profile else BuildProfile()
+        self.archive = archive
+        self.archive_digests = {} # Filename: digest of its contents, for the songs loaded from self.archive.
+        songs = self.songs_from_archive() if archive else self.songs_from_directory(songs_path)
+        self.songs_by_filename = {song.filename: song for song in songs}
+        if self.cache:
+            logging.info("Parsed %d songs (%d unchanged and loaded from the cache)", len(self.songs_by_filename), self.cache.hits)
+            self.cache.save(prune=True)
+        else:
+            logging.info("Parsed %d songs", len(self.songs_by_filename))
+        self.link()
 
         # Format cat names & song counts to fit in columns on a 80 char screen.
         strs = ["%s: %d" % (category.name, len(category.songs)) for category in self.categories]
@@ -206,25 +1319,251 @@ class SongBook:
         if uncategorized:
             logging.info("%d songs have no categories: %s" % (len(uncategorized), uncategorized))
 
+    def __getstate__(self):
+        """Leave out the cache and profile when pickled (e.g. for worker processes), as they can't be shared."""
+        state = self.__dict__.copy()
+        state["cache"] = None
+        state["profile"] = BuildProfile()
+        return state
+
+    def link(self):
+        """(Re-)link all the songs and categories, then sort them.
+
+        Songs are always linked in the order of their filenames, so that the results (e.g. which of several songs
+        with the same slug needs a uniquing number) don't depend on the order the songs were loaded or updated in.
+        """
+        with self.profile.phase("linking"):
+            self.songs = [self.songs_by_filename[filename] for filename in sorted(self.songs_by_filename)]
+            self.link_songs_and_categories()
+            self.index_slugs()
+        with self.profile.phase("sorting"):
+            self.songs.sort(key=lambda song: song.title.lower())
+            self.categories.sort(key=lambda cat: cat.name.lower())
+            for categories in self.categories:
+                categories.songs.sort(key=lambda song: song.title.lower())
+
+    def index_slugs(self):
+        """Fix the slug and URL of each song and category once linked, and index them by slug (for use in templates).
+
+        Sets self.songs_by_slug and self.categories_by_slug.  A song's url (like a category's) is relative to the root of
+        the site, e.g. "/songs/some-title/".
+        """
+        self.songs_by_slug = {}
+        for song in self.songs:
+            song.url = posixpath.sep + posixpath.join(SONGS_DIR, song.slug, "")
+            self.songs_by_slug[song.slug] = song
+        self.categories_by_slug = {}
+        for category in self.categories:
+            category.url = posixpath.sep + posixpath.join(CATEGORIES_DIR, category.slug, "")
+            self.categories_by_slug[category.slug] = category
+
+    def update_songs(self, filenames):
+        """Reload the given song files (relative to the songs directory), then re-link the songbook if any changed.
+
+        Files which no longer exist are removed from the songbook.  A directory (or "." for the whole songs directory)
+        stands for all the song files within it, before and after the change (e.g. for a directory that was moved or
+        deleted).  Returns the set of filenames whose songs were added, removed, or changed.
+        """
+        song_files = []
+        removed = []
+        filenames = set(filenames)
+        for dirname in [filename for filename in filenames if filename not in self.songs_by_filename]:
+            dirname = "" if dirname == os.path.curdir else dirname # The songs directory itself, e.g. moved back in place.
+            prefix = os.path.join(dirname, "")
+            filenames.update(filename for filename in self.songs_by_filename if filename.startswith(prefix))
+            if os.path.isdir(os.path.join(self.songs_path, dirname)) and not (dirname and self.is_excluded(dirname)):
+                filenames.update(filename for _, filename in
+                                 discover_song_files(self.songs_path, self.include, self.exclude, subdirectory=dirname))
+        for filename in sorted(filenames):
+            filepath = os.path.join(self.songs_path, filename)
+            if os.path.isfile(filepath) and self.is_song_file(filename):
+                song_files.append((filepath, filename))
+            elif filename in self.songs_by_filename:
+                removed.append(filename)
+        return self.replace_songs(removed, self.songs_from_files(song_files))
+
+    def update_archive(self):
+        """Reload the songs from self.archive, then re-link the songbook if any changed.
+
+        Only the songs whose contents have changed are parsed again.  Returns the set of filenames whose songs were
+        added, removed, or changed.
+        """
+        old_filenames = set(self.archive_digests)
+        songs = self.songs_from_archive()
+        return self.replace_songs(old_filenames.difference(self.archive_digests), songs)
+
+    def replace_songs(self, removed, songs):
+        """Remove the songs with the given filenames and add (or replace) the given songs, then re-link the songbook if
+        any changed, returning the set of filenames whose songs were added, removed, or changed."""
+        changed = set()
+        for filename in removed:
+            del self.songs_by_filename[filename]
+            if self.cache:
+                self.cache.discard(filename)
+            changed.add(filename)
+        for song in songs:
+            old_song = self.songs_by_filename.get(song.filename)
+            # Songs loaded with low_memory don't keep their lyrics to compare, so are assumed to have changed.
+            if old_song is None or self.low_memory or old_song.to_record() != song.to_record():
+                self.songs_by_filename[song.filename] = song
+                changed.add(song.filename)
+        if self.cache:
+            self.cache.save(min_interval=CACHE_SAVE_INTERVAL) # Anything left unsaved is saved when watching stops.
+        if changed:
+            self.link()
+        return changed
+
     def songs_from_directory(self, path):
-        """Return an array of Song objects for all song files in a given directory."""
-        songs = []
-        for filename in os.listdir(path):
-            # TODO: Should we recurse into subdirectories?
-            filepath = os.path.join(path, filename)
-            if os.path.isfile(filepath):
-                name, ext = os.path.splitext(filepath)
-                if ext == SONG_EXTENSION:
-                    song_file = open(filepath).read()
-                    songs.append(Song.from_string(song_file, filename=filename))
-                    # TODO: warn if song title's slug version and filename's slug version aren't the same.
-        return songs
+        """Return an array of Song objects for all song files in a given directory (and its subdirectories), in the order
+        of their filenames (i.e. paths relative to the directory)."""
+        with self.profile.phase("discovery"):
+            song_files = discover_song_files(path, self.include, self.exclude)
+        return self.songs_from_files(song_files)
+
+    def songs_from_archive(self):
+        """Return an array of Song objects for the songs in self.archive whose contents have changed since they were last
+        loaded from it (i.e. all of them, the first time), reading them from the archive one at a time.
+
+        Songs whose filenames don't match the include and exclude patterns are left out, and self.archive_digests is
+        replaced with the digests of the rest.  As with song files, songs found in self.cache aren't parsed again, and
+        the others are parsed by self.jobs worker processes (if more than one).
+        """
+        with self.profile.phase("parsing"):
+            digests = {}
+            records = []
+            skipped = 0
+            def jobs():
+                nonlocal skipped
+                for filename, contents in self.archive.songs():
+                    if not self.is_song_file(filename):
+                        skipped += 1
+                        continue
+                    digest = digests[filename] = hashlib.sha1(contents).hexdigest()
+                    if self.archive_digests.get(filename) == digest:
+                        continue
+                    record = self.cache.lookup(filename, None, digest) if self.cache else None
+                    if record is None:
+                        yield filename, contents, self.low_memory
+                    else:
+                        records.append(record)
+            if self.jobs > 1:
+                # Worker processes need all the songs to parse up front.
+                pending = list(jobs())
+                results = zip(pending, parallel_map(parse_archived_song, pending, self.jobs,
+                                                    chunksize=max(1, min(64, len(pending) // (self.jobs * 4)))))
+            else:
+                results = ((job, parse_archived_song(job)) for job in jobs())
+            parsed = 0
+            for (filename, contents, metadata_only), (stat, digest, record, markdown_time) in results:
+                parsed += 1
+                if self.cache:
+                    self.cache.store(filename, None, digest, record)
+                if markdown_time:
+                    self.profile.add("markdown", *markdown_time)
+                records.append(record)
+            if skipped:
+                logging.info("Left out %d songs in the song archive which don't match the include and exclude patterns", skipped)
+            self.profile.count("songs_parsed", parsed)
+            self.profile.count("songs_from_cache", len(records) - parsed)
+            self.archive_digests = digests
+            songs = [Song.from_record(record) for record in records]
+            if self.low_memory:
+                lyrics_loader = self.read_lyrics
+                for song in songs:
+                    song._lyrics_loader = lyrics_loader
+            return songs
+
+    def is_excluded(self, path):
+        """Return whether a file or directory (relative to the songs directory) would be skipped by discover_song_files,
+        either itself or as part of a skipped directory."""
+        parts = path.split(os.path.sep)
+        if any(part.startswith(".") for part in parts):
+            return True
+        return any(matches_pattern(os.path.join(*parts[:depth]), self.exclude) for depth in range(1, len(parts) + 1))
+
+    def is_song_file(self, filename):
+        """Return whether a file (relative to the songs directory) would be found by discover_song_files."""
+        return not self.is_excluded(filename) and matches_pattern(filename, self.include)
+
+    def songs_from_files(self, song_files):
+        """Return an array of Song objects for a list of (filepath, filename) tuples, in the same order.
+
+        Song files not found in self.cache are parsed by self.jobs worker processes (if more than one).
+        """
+        with self.profile.phase("parsing"):
+            records = [None] * len(song_files)
+            if self.cache:
+                stats = threaded_map(os.stat, [filepath for filepath, filename in song_files], self.read_threads)
+                for index, ((filepath, filename), stat) in enumerate(zip(song_files, stats)):
+                    records[index] = self.cache.lookup(filename, stat)
+            to_parse = [index for index, record in enumerate(records) if record is None]
+            jobs = [song_files[index] + (self.cache.digest(song_files[index][1]) if self.cache else None, self.encoding)
+                    for index in to_parse]
+            if self.jobs > 1 and len(jobs) > 1:
+                parse = parse_song_metadata if self.low_memory else parse_song_file
+                results = parallel_map(parse, jobs, self.jobs, chunksize=max(1, min(64, len(jobs) // (self.jobs * 4))))
+            else:
+                # Parsed here, but with the files read ahead on other threads.
+                files = threaded_map(read_song_file, [job[0] for job in jobs], self.read_threads)
+                results = (parse_song_contents(job, stat, contents, metadata_only=self.low_memory)
+                           for job, (stat, contents) in zip(jobs, files))
+            parsed = 0
+            for index, (stat, digest, record, markdown_time) in zip(to_parse, results):
+                filename = song_files[index][1]
+                if record is None:
+                    record = self.cache.lookup(filename, stat, digest)
+                else:
+                    parsed += 1
+                    if self.cache:
+                        self.cache.store(filename, stat, digest, record)
+                if markdown_time:
+                    self.profile.add("markdown", *markdown_time)
+                records[index] = record
+            self.profile.count("songs_parsed", parsed)
+            self.profile.count("songs_from_cache", len(song_files) - parsed)
+            songs = [Song.from_record(record) for record in records]
+            if self.low_memory:
+                lyrics_loader = self.read_lyrics
+                for song in songs:
+                    song._lyrics_loader = lyrics_loader
+            return songs
+
+    def read_lyrics(self, song):
+        """Read the (Markdown) lyrics of a song from its file (or the archive), for songs loaded by a low_memory SongBook."""
+        try:
+            if self.archive:
+                return Song.split_file(decode_song(self.archive.read(song.filename), song.filename))[1]
+            with open(os.path.join(self.songs_path, song.filename), 'rb') as song_file:
+                return Song.split_file(decode_song(song_file.read(), song.filename, self.encoding))[1]
+        except (OSError, SongArchiveError) as error:
+            logging.warning("Couldn't re-read the lyrics of \"%s\": %s" % (song.filename, error))
+            return ""
+
+    def page_dependencies(self):
+        """Return a dict mapping each song's filename to the paths of the song and category pages which depend on it.
+
+        A song's own page, the pages of songs that link to it in their "See:" tags, and the pages of its categories
+        (which in turn list the "See:" links of their songs) all depend on it.  Pages listing all the songs
+        (e.g. index.html) depend on every song, so aren't included.
+        """
+        dependencies = {song.filename: {os.path.join(SONGS_DIR, song.slug)} for song in self.songs}
+        for song in self.songs:
+            song_pages = {os.path.join(SONGS_DIR, song.slug)}
+            for name, category in song.categories:
+                if category:
+                    song_pages.add(os.path.join(CATEGORIES_DIR, category.slug))
+            dependencies[song.filename].update(song_pages)
+            for title, see_song in song.see:
+                if see_song:
+                    dependencies[see_song.filename].update(song_pages)
+        return dependencies
 
     def link_songs_and_categories(self):
         """Create categories and make song and category objects refer to each other when referenced by name in tags."""
         songs_by_slug = {}
         # Add all songs by their default title.
         for song in self.songs:
+            song.uniquing_string = "" # Clear any from previously linking.
             slug = slugify(song.title)
             if slug not in songs_by_slug:
                 songs_by_slug[slug] = []
@@ -276,9 +1615,9 @@ class SongBook:
                 return None
             songs = songs_by_slug[slug]
             if len(songs) > 1:
-                title_songs = [s for s in songs if title == song.title]
-                songs = [s for s in songs if title == song.title or title in song.aka]
-                if len(aka_songs) > len(title_songs) >= 1:
+                title_songs = [s for s in songs if title == s.title]
+                songs = [s for s in songs if title == s.title or title in s.aka]
+                if len(songs) > len(title_songs) >= 1:
                     logging.warning(("Title \"%s\" is the title of a song and the alternate title of a song (AKA: tag).  "
                                                                                     "Only using the direct title.") % title)
                     songs = title_songs
@@ -291,7 +1630,7 @@ class SongBook:
                 return songs[0]
             else:
                 # TODO: Should we error on duplicate titles here or elsewhere?
-                logging.warning("Title \"\" matches two songs.  Picking one arbitrarily." % title)
+                logging.warning("Title \"%s\" matches two songs.  Picking one arbitrarily." % title)
                 return songs[0]
 
         def category_for_tag(name):
@@ -318,11 +1657,37 @@ class SongBook:
 
 class SiteBuilder:
     """Create a static website based on song files and templates read in."""
-    def __init__(self, source, destination, keep, base_path):
+    def __init__(self, source, destination, keep, base_path, cache_dir=None, rebuild=False, jobs=1, staged=False,
+                 static_mode="copy", static_hash=False, full_clean=False, precompress=False,
+                 search_index=False, profile=None, low_memory=False, page_size=0, page_by_letter=False,
+                 include=SONG_PATTERNS, exclude=(), encoding=SONG_ENCODING, read_threads=READ_THREADS,
+                 precompiled_templates=None, preview=False, songs_archive=None):
         self.source = source
         self.destination = destination
         self.keep = keep
         self.base_path = base_path if base_path else ""
+        self.cache_dir = cache_dir
+        self.rebuild = rebuild
+        self.jobs = jobs
+        self.staged = staged
+        self.static_mode = static_mode
+        self.static_hash = static_hash
+        self.full_clean = full_clean
+        self.precompress = precompress
+        self.search_index = search_index
+        self.profile = profile if profile else BuildProfile()
+        self.low_memory = low_memory
+        self.page_size = page_size
+        self.page_by_letter = page_by_letter
+        self.paginations = {}
+        self.include = include
+        self.exclude = exclude
+        self.encoding = encoding
+        self.read_threads = read_threads
+        self.precompiled_templates = precompiled_templates
+        self.preview = preview
+        self.page_specs = None
+        self.lock = threading.RLock() # Held while updating the site, e.g. so previewed pages aren't rendered meanwhile.
 
         self.songs_path = os.path.join(self.source, "songs")
         self.templates_path = os.path.join(self.source, "templates")
@@ -333,21 +1698,79 @@ class SiteBuilder:
         if not os.path.isdir(self.source):
             logging.error("Source '%s' is not a directory" % source_path)
             sys.exit(os.EX_NOINPUT)
-        for required_path in (self.songs_path, self.templates_path):
+        for required_path in (self.templates_path,) if songs_archive else (self.songs_path, self.templates_path):
             if not os.path.isdir(required_path):
                 logging.error("Source directory does not contain a %s subdirectory" % os.path.basename(required_path))
                 sys.exit(os.EX_NOINPUT)
-        self.templates = jinja2.Environment(loader=jinja2.FileSystemLoader(self.templates_path))
-        self.templates.filters['datetimeformat'] = lambda value, format='%B %d, %Y, %-I:%M %p': value.strftime(format)
+        self.songs_archive = None # If set, the SongArchive the songs are loaded from, instead of the songs directory.
+        if songs_archive:
+            if not os.path.isfile(songs_archive):
+                logging.error("Could not find song archive '%s'" % songs_archive)
+                sys.exit(os.EX_NOINPUT)
+            self.songs_archive = SongArchive(songs_archive)
+        self.templates = self.template_environment()
         self.copied_files = set()
-        self.generated_files = set()
+        self.created_files = set()
+        self.search_files = set()
+        self.compressed_files = set()
+        self.dirty_pages = set()
+        self.search_index_dirty = False # Whether songs have changed since the search index was last written.
+        self.listeners = [] # Called with the pages to re-render (see render_templates) after changes are processed.
+        # The parse cache holds every song's lyrics, so can't be used in low memory mode.
+        self.parse_cache = (ParseCache(self.cache_dir, rebuild=self.rebuild, encoding=self.encoding)
+                            if self.cache_dir and not low_memory else None)
+        self.manifest = None
+        self.output_digests = {} # Output filename: (SHA-1 digest, modification time) of the file, for rendered pages.
+        self.manifest_digests = None
         self.gather_metadata()
 
+    def template_environment(self):
+        """Return a new Jinja environment for loading the templates.
+
+        Compiled templates are cached as bytecode in the cache directory (if any), so they're only compiled again (by
+        a later build, or a worker process) when their source changes.  If self.precompiled_templates is set, the
+        templates are loaded from the modules there (see compile_templates) instead, unless they're out of date.
+        """
+        import jinja2
+        bytecode_cache = None
+        if self.cache_dir:
+            bytecode_path = os.path.join(self.cache_dir, TEMPLATE_CACHE_DIR)
+            os.makedirs(bytecode_path, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_path)
+        loader = jinja2.FileSystemLoader(self.templates_path)
+        if self.precompiled_templates:
+            if self.precompiled_templates_current():
+                loader = jinja2.ModuleLoader(self.precompiled_templates)
+            else:
+                logging.warning("Precompiled templates in \"%s\" don't match the templates; using the templates instead."
+                                % self.precompiled_templates)
+        templates = jinja2.Environment(loader=loader, bytecode_cache=bytecode_cache)
+        templates.filters['datetimeformat'] = datetimeformat
+        return templates
+
+    def precompiled_templates_current(self):
+        """Return whether the modules in self.precompiled_templates were compiled from the current templates."""
+        try:
+            with open(os.path.join(self.precompiled_templates, COMPILED_TEMPLATES_MANIFEST), encoding="utf-8") as manifest_file:
+                return json.load(manifest_file) == template_sources(self.templates_path)
+        except (OSError, ValueError):
+            return False
+
+    def __getstate__(self):
+        """Leave out the template environment, cache and profile when pickled (e.g. for worker processes), as they can't be shared."""
+        state = self.__dict__.copy()
+        state["templates"] = None
+        state["parse_cache"] = None
+        state["profile"] = None
+        state["lock"] = None
+        return state
+
     def gather_metadata(self):
         self.metadata = {}
         self.metadata["date"] = datetime.datetime.now()
         self.metadata["version"] = __version__
         # Gather # of parent commits, branch, sha, etc. from git repo (if present)
+        import subprocess
         try:
             common_args = {"cwd": self.source, "stderr": subprocess.DEVNULL}
             version = subprocess.check_output(["git", "rev-list", "HEAD", "--count"], **common_args).decode('utf-8').strip()
@@ -375,119 +1798,531 @@ class SiteBuilder:
             logging.warning("Can't run git to check for version information")
             return
 
+    def load_songbook(self):
+        """Load (or reload) all the songs into self.songbook."""
+        self.songbook = SongBook(self.songs_path, cache=self.parse_cache, jobs=self.jobs, profile=self.profile,
+                                 low_memory=self.low_memory, include=self.include, exclude=self.exclude,
+                                 encoding=self.encoding, read_threads=self.read_threads, archive=self.songs_archive)
+        self.paginations = {}
+        self.page_specs = None
+
     def build_site(self):
-        self.songbook = SongBook(self.songs_path)
-        self.copy_static()
-        self.render_templates()
-        for path in set.intersection(self.copied_files, self.created_files):
-            logging.warning("File \"%s\" from static was overwritten by a generated file." % path)
-        self.delete_old_files()
-
-    def render_templates(self):
-        """Renders all the templates into destination directory based on our Songs and Categories."""
-        self.created_files = set()
-        def mkdir_f(dir_path):
-            """Forcibly create a directory at dir_path, removing any file there, and with no error for existing directories."""
-            if not os.path.isdir(dir_path):
-                if os.path.exists(dir_path):
-                    os.remove(dir_path)
-                os.mkdir(dir_path)
-        def mkdir_f_p(dir_path):
-            """Forcibly create a directory at dir_path, (and all parent directories that don't exist, up to self.destination)."""
-            if dir_path == "":
-                dir_path = os.path.curdir
-            rel_path = os.path.relpath(dir_path, self.destination)
-            if rel_path.startswith(os.path.pardir+os.path.sep):
-                return
-            head, tail = os.path.split(rel_path)
-            if head:
-               mkdir_f_p(os.path.join(self.destination, head))
-            else:
-                mkdir_f(self.destination)
-            mkdir_f(dir_path)
-        def render_template(output_path, template_name, optional=False, **context):
-            output_filename = os.path.join(output_path, "index.html")
+        self.load_songbook()
+        self.load_manifest() # For the digests of previously rendered pages.
+        destination = self.destination
+        if self.staged:
+            self.destination = self.prepare_staging_directory()
+        try:
+            with self.profile.phase("static"):
+                self.copy_static()
+            with self.profile.phase("rendering"):
+                self.render_templates()
+            if self.search_index:
+                with self.profile.phase("search_index"):
+                    self.write_search_index()
+            if self.precompress:
+                with self.profile.phase("precompress"):
+                    self.precompress_files()
+            if logging.getLogger().isEnabledFor(logging.DEBUG): # Finding each template's outputs isn't free.
+                for template_name, urls in sorted(self.template_outputs().items()):
+                    logging.debug("Template \"%s\" is used to render: %s" % (template_name, ", ".join(urls) if urls else "nothing"))
+            for path in set.intersection(self.copied_files, self.created_files):
+                logging.warning("File \"%s\" from static was overwritten by a generated file." % path)
+            with self.profile.phase("cleanup"):
+                self.delete_old_files()
+            if self.staged:
+                with self.profile.phase("publishing"):
+                    self.publish_staging_directory(destination)
+        finally:
+            self.destination = destination
+
+    def prepare_staging_directory(self):
+        """Create a staging directory next to the destination, in which to build the site before publishing it all at once.
+
+        The staging directory starts as a copy of the destination (except for any paths in self.keep), hard-linking
+        files where possible.  Since all output files are replaced rather than written in place, this is cheap and
+        won't modify the files in the destination, while still letting unchanged files be left alone.
+        """
+        staging_path = self.destination.rstrip(os.path.sep) + ".staging"
+        if os.path.lexists(staging_path):
+            shutil.rmtree(staging_path)
+        if not os.path.isdir(self.destination):
+            os.makedirs(staging_path)
+            return staging_path
+        keep_paths = set(os.path.normpath(os.path.join(self.destination, keep_file)) for keep_file in self.keep)
+        def ignore_kept(dirpath, names):
+            return [name for name in names if os.path.normpath(os.path.join(dirpath, name)) in keep_paths]
+        def link_or_copy(src_path, path):
             try:
-                try:
-                    template = self.templates.get_template(template_name)
-                except jinja2.exceptions.TemplateNotFound as exception:
-                    if optional:
-                        logging.debug("Optional template not found: {0.message}".format(exception))
-                        return
-                    else:
-                        logging.error("Required template not found: {0.message}".format(exception))
-                        sys.exit(os.EX_NOINPUT)
-                try:
-                    url = posixpath.sep + (output_path + posixpath.sep if output_path else "")
-                    html = template.render(metadata=self.metadata, songbook=self.songbook, base_path=self.base_path, url=url, **context)
-                except jinja2.exceptions.TemplateNotFound as exception:
-                    logging.error("Referenced template not found: {0.message}".format(exception))
-                    sys.exit(os.EX_DATAERR)
-            except jinja2.exceptions.TemplateSyntaxError as exception:
-                exception.translated = False # Since we're skipping the information translated into the traceback...
-                logging.error("Error rendering template '{0}':\n  {1}".format(template_name, exception))
-                sys.exit(os.EX_DATAERR)
-            full_output_path = os.path.join(self.destination, output_filename)
-            mkdir_f_p(os.path.dirname(full_output_path))
+                os.link(src_path, path)
+            except OSError:
+                shutil.copy2(src_path, path)
+        shutil.copytree(self.destination, staging_path, symlinks=True, ignore=ignore_kept, copy_function=link_or_copy)
+        logging.debug("Building site in staging directory \"%s\"" % staging_path)
+        return staging_path
+
+    def publish_staging_directory(self, destination):
+        """Replace destination with the (finished) staging directory in self.destination, moving over any paths in self.keep.
+
+        Where possible (see try_exchange) the two are swapped atomically.  Otherwise the destination is moved aside and
+        the staging directory renamed in its place, so the destination briefly doesn't exist.
+        """
+        for keep_file in self.keep:
+            kept_path = os.path.join(destination, keep_file)
+            if os.path.lexists(kept_path):
+                os.makedirs(os.path.dirname(os.path.join(self.destination, keep_file)), exist_ok=True)
+                os.rename(kept_path, os.path.join(self.destination, keep_file))
+        old_path = destination.rstrip(os.path.sep) + ".old"
+        if os.path.lexists(old_path):
+            shutil.rmtree(old_path)
+        if os.path.isdir(destination) and not os.path.islink(destination) and try_exchange(self.destination, destination):
+            # Swapped in a single step, so there's never a moment without a destination; the old site is now in staging.
+            shutil.rmtree(self.destination)
+        else:
+            # Otherwise there's a moment between these two renames when the destination doesn't exist.
+            if os.path.lexists(destination):
+                os.rename(destination, old_path)
+            os.rename(self.destination, destination)
+            if os.path.lexists(old_path):
+                shutil.rmtree(old_path)
+        logging.debug("Published staging directory to \"%s\"" % destination)
+
+    def render_templates(self, only=None, cancelled=None):
+        """Renders all the templates into destination directory based on our Songs and Categories.
+
+        The individual song and category pages are split into chunks and rendered by self.jobs worker processes
+        (if more than one), each with its own template environment and a read-only copy of this SiteBuilder.
+
+        If only is given, only pages with output paths (or, for single pages of paginated listings, output filenames)
+        in it are rendered; the rest are assumed to be unchanged since they were last rendered.  If cancelled is given,
+        it's checked periodically, and RebuildCancelled is raised (leaving self.created_files as it was) if it returns
+        True.
+        """
+        created_files = set()
+        single_pages, multiple_pages = self.pages()
+        if only is not None:
+            def selected(page):
+                output_filename = self.page_filename(page)
+                if page[0] in only or output_filename in only:
+                    return True
+                if output_filename in self.created_files:
+                    created_files.add(output_filename)
+                return False
+            single_pages = [page for page in single_pages if selected(page)]
+            multiple_pages = [page for page in multiple_pages if selected(page)]
+            logging.debug("Re-rendering %d pages" % (len(single_pages) + len(multiple_pages)))
+        for page in single_pages:
+            if cancelled and cancelled():
+                raise RebuildCancelled()
+            created_files.add(self.render_page_spec(page))
+        chunksize = max(1, min(RENDER_CHUNK_SIZE, -(-len(multiple_pages) // (self.jobs * 4))))
+        chunks = [multiple_pages[start:start + chunksize] for start in range(0, len(multiple_pages), chunksize)]
+        # On Linux, worker processes are forked, so they can share a snapshot of the songbook without pickling it, but
+        # only while no other threads (e.g. watching or serving) are running, which could leave locks held in the
+        # workers.  Otherwise they're started as is usual on the platform (and sent a pickled copy of this SiteBuilder).
+        start_method = "fork" if sys.platform.startswith("linux") and threading.active_count() == 1 else None
+        for chunk_digests, chunk_stats in parallel_map(_render_pages, chunks, self.jobs, initializer=_initialize_render_worker,
+                                                       initargs=(self,), start_method=start_method, cancelled=cancelled):
+            created_files.update(chunk_digests)
+            self.output_digests.update(chunk_digests)
+            self.profile.merge(chunk_stats)
+        created_files.discard(None)
+        self.created_files = created_files
+
+    def pages(self):
+        """Return lists of the pages in the site which are rendered once, and once per song or category.
+
+        Each page is specified by a tuple of its output path, template name, whether the template is optional, the kind
+        of object it's rendered for ("category" or "song") and its index (in self.songbook), or the kind of listing it
+        shows (see paginate), if any, and its page number, if it's one page of a listing (see paginate).
+        """
+        listings = [("", "index.html", False, "songs"),
+                    (SONGS_DIR, "songs.html", False, "songs"),
+                    (CATEGORIES_DIR, "categories.html", False, "categories"),
+                    ("about", "about.html", True, None),
+                    ("bytitle", "bytitle.html", True, "songs"),
+                    ("bycategory", "bycategory.html", True, "categories"),
+                    ("firstlines", "firstlines.html", True, "first_lines")]
+        single_pages = []
+        for output_path, template_name, optional, listing in listings:
+            if listing is None:
+                single_pages.append((output_path, template_name, optional, None, None, None))
+                continue
+            for page in self.paginate(listing):
+                single_pages.append((output_path, template_name, optional, listing, None, page.number))
+        multiple_pages = []
+        for index, category in enumerate(self.songbook.categories):
+            for page in self.paginate("category", index):
+                multiple_pages.append((os.path.join(CATEGORIES_DIR, category.slug), "category.html", False, "category", index, page.number))
+        for index, song in enumerate(self.songbook.songs):
+            multiple_pages.append((os.path.join(SONGS_DIR, song.slug), "song.html", False, "song", index, None))
+        return single_pages, multiple_pages
+
+    def paginate(self, listing, index=None):
+        """Return the list of Pages a listing is split into, according to self.page_size and self.page_by_letter.
+
+        listing is "songs" (all the songs, by title), "first_lines" (all the songs, by first line), "categories" (all the
+        categories), or "category" (the songs in the category at index).  Listings are split into pages of
+        self.page_size items, or by initial letter if self.page_by_letter is set, or else not split (into one page).
+        Results are kept in self.paginations until the songbook changes.
+        """
+        key = (listing, index)
+        if key in self.paginations:
+            return self.paginations[key]
+        if listing == "songs":
+            items, text = self.songbook.songs, lambda song: song.title
+        elif listing == "first_lines":
+            items = sorted(self.songbook.songs, key=lambda song: song.first_line.lower())
+            text = lambda song: song.first_line
+        elif listing == "categories":
+            items, text = self.songbook.categories, lambda category: category.name
+        else:
+            items, text = self.songbook.categories[index].songs, lambda song: song.title
+        if self.page_by_letter:
+            letters = collections.OrderedDict()
+            for item in items:
+                letters.setdefault(initial_letter(text(item)), []).append(item)
+            groups = sorted(letters.items())
+        elif self.page_size:
+            groups = [(str(start // self.page_size + 1), items[start:start + self.page_size])
+                      for start in range(0, len(items), self.page_size)]
+        else:
+            groups = []
+        if not groups:
+            groups = [("1", items)]
+        pages = []
+        for number, (label, page_items) in enumerate(groups, 1):
+            filename = "index.html" if number == 1 else "page-%s.html" % (label if label != "#" else "other")
+            pages.append(Page(number, label.upper(), page_items, filename))
+        self.paginations[key] = pages
+        return pages
+
+    def page_filename(self, page):
+        """Return the output filename (relative to the destination) of a page specified by a tuple from self.pages()."""
+        output_path, template_name, optional, kind, index, page_number = page
+        filename = self.paginate(kind, index)[page_number - 1].filename if page_number else "index.html"
+        return os.path.join(output_path, filename)
+
+    def listing_page_signatures(self):
+        """Return a dict mapping the output filenames of the pages of listings of all songs or categories to signatures
+        of their contents (the songs or categories they list, and the other pages they link to).
+        """
+        signatures = {}
+        for page in self.pages()[0]:
+            output_path, template_name, optional, kind, index, page_number = page
+            if page_number:
+                pages = self.paginate(kind, index)
+                keys = tuple(item.filename if isinstance(item, Song) else item.slug for item in pages[page_number - 1].items)
+                signatures[self.page_filename(page)] = (tuple(other_page.label for other_page in pages), keys)
+        return signatures
+
+    def page_index(self):
+        """Return a dict mapping the output filename of each page (relative to the destination, with "/" separators) to
+        its tuple from self.pages(), e.g. for looking pages up by URL.  Kept until the songbook changes."""
+        if self.page_specs is None:
+            single_pages, multiple_pages = self.pages()
+            self.page_specs = {self.page_filename(page).replace(os.path.sep, posixpath.sep): page
+                               for page in single_pages + multiple_pages}
+        return self.page_specs
+
+    def render_page_contents(self, page):
+        """Render a page specified by a tuple from self.pages() in memory (e.g. for previewing the site), returning its
+        contents as bytes, or None if its template is optional and doesn't exist.  Template errors are raised."""
+        import jinja2
+        output_path, template_name, optional = page[:3]
+        filename, context = self.page_context(page)
+        try:
+            template = self.templates.get_template(template_name)
+        except jinja2.exceptions.TemplateNotFound as exception:
+            if optional and exception.name == template_name:
+                return None
+            raise
+        start = time.perf_counter()
+        html = template.render(metadata=self.metadata, songbook=self.songbook, base_path=self.base_path,
+                               url=site_url(output_path, filename), **context)
+        self.profile.add_template(template_name, time.perf_counter() - start)
+        return html.encode(OUTPUT_ENCODING)
+
+    def render_page_spec(self, page):
+        """Render a page specified by a tuple from self.pages(), returning the created file (if any)."""
+        output_path, template_name, optional = page[:3]
+        filename, context = self.page_context(page)
+        return self.render_template(output_path, template_name, optional, filename=filename, **context)
+
+    def page_context(self, page):
+        """Return the output filename (within its output path) and the template context (besides that given to every
+        template) of a page specified by a tuple from self.pages()."""
+        output_path, template_name, optional, kind, index, page_number = page
+        context = {}
+        if kind == "category":
+            context["category"] = self.songbook.categories[index]
+        elif kind == "song":
+            context["song"] = self.songbook.songs[index]
+        filename = "index.html"
+        if page_number:
+            pages = self.paginate(kind, index)
+            context["pages"] = pages
+            context["page"] = pages[page_number - 1]
+            context["previous_page"] = pages[page_number - 2] if page_number > 1 else None
+            context["next_page"] = pages[page_number] if page_number < len(pages) else None
+            filename = context["page"].filename
+        return filename, context
+
+    def mkdir_f(self, dir_path):
+        """Forcibly create a directory at dir_path, removing any file there, and with no error for existing directories."""
+        if not os.path.isdir(dir_path):
+            if os.path.exists(dir_path):
+                os.remove(dir_path)
+            os.mkdir(dir_path)
+
+    def mkdir_f_p(self, dir_path):
+        """Forcibly create a directory at dir_path, (and all parent directories that don't exist, up to self.destination)."""
+        if dir_path == "":
+            dir_path = os.path.curdir
+        rel_path = os.path.relpath(dir_path, self.destination)
+        if rel_path.startswith(os.path.pardir+os.path.sep):
+            return
+        head, tail = os.path.split(rel_path)
+        if head:
+            self.mkdir_f_p(os.path.join(self.destination, head))
+        else:
+            self.mkdir_f(self.destination)
+        self.mkdir_f(dir_path)
+
+    def render_template(self, output_path, template_name, optional=False, filename="index.html", **context):
+        """Render template_name to a file (index.html, or filename) in output_path (relative to the destination),
+        returning its path.
+
+        The page is streamed to the file as it's rendered, rather than built up in memory, and its digest recorded in
+        self.output_digests (with the file's modification time) to tell whether it's changed next time.  Returns None
+        (rather than exiting) if an optional template doesn't exist.
+        """
+        import jinja2
+        output_filename = os.path.join(output_path, filename)
+        full_output_path = os.path.join(self.destination, output_filename)
+        try:
+            try:
+                template = self.templates.get_template(template_name)
+            except jinja2.exceptions.TemplateNotFound as exception:
+                if optional:
+                    logging.debug("Optional template not found: {0.message}".format(exception))
+                    return None
+                else:
+                    logging.error("Required template not found: {0.message}".format(exception))
+                    sys.exit(os.EX_NOINPUT)
+            self.mkdir_f_p(os.path.dirname(full_output_path))
             if os.path.isdir(full_output_path):
-                shutils.rmtree(full_output_path)
-            with open(full_output_path, 'w') as output_file:
-                output_file.write(html)
-            self.created_files.add(output_filename)
-
-        songs_dir = "songs"
-        categories_dir = "categories"
-        render_template("", "index.html")
-        render_template("songs", "songs.html")
-        render_template("categories", "categories.html")
-        for category in self.songbook.categories:
-            render_template(os.path.join(categories_dir, "%s" % category.slug), "category.html", category=category)
-        for song in self.songbook.songs:
-            render_template(os.path.join(songs_dir, "%s" % song.slug), "song.html", song=song)
-        render_template("about", "about.html", optional=True)
-        render_template("bytitle", "bytitle.html", optional=True)
-        render_template("bycategory", "bycategory.html", optional=True)
-        render_template("firstlines", "firstlines.html", optional=True)
+                shutil.rmtree(full_output_path)
+            try:
+                rendering = [0, 0] # Wall and CPU time spent rendering, but not writing, the page.
+                html = template.generate(metadata=self.metadata, songbook=self.songbook, base_path=self.base_path,
+                                         url=site_url(output_path, filename), **context)
+                written, digest, size = publish_stream(full_output_path,
+                                                       timed_iter(encode_chunks(html, OUTPUT_ENCODING), rendering),
+                                                       self.output_digests.get(output_filename), profile=self.profile)
+                self.profile.add_template(template_name, rendering[0])
+            except jinja2.exceptions.TemplateNotFound as exception:
+                logging.error("Referenced template not found: {0.message}".format(exception))
+                sys.exit(os.EX_DATAERR)
+        except jinja2.exceptions.TemplateSyntaxError as exception:
+            exception.translated = False # Since we're skipping the information translated into the traceback...
+            logging.error("Error rendering template '{0}':\n  {1}".format(template_name, exception))
+            sys.exit(os.EX_DATAERR)
+        self.output_digests[output_filename] = digest
+        self.count_written(written, size)
+        return output_filename
+
+    def publish(self, path, contents):
+        """Write contents to the file at path with publish_file, recording the time taken and bytes written in self.profile."""
+        with self.profile.phase("writing"):
+            written = publish_file(path, contents)
+        self.count_written(written, len(contents))
+        return written
+
+    def count_written(self, written, size):
+        """Count a file of size bytes as written (if written) or skipped in self.profile."""
+        if written:
+            self.profile.count("files_written")
+            self.profile.count("bytes_written", size)
+        else:
+            self.profile.count("files_skipped")
 
     def copy_static(self):
         """Copy files and their directory structure from static directory to the output directory.
 
-        Files are copied, as are any directories containing them, but empty directories are excluded, as they would be
-        removed by delete_old_files later in the website generation process.
+        Files are copied (or linked, depending on self.static_mode), as are any directories containing them, but empty
+        directories are excluded, as they would be removed by delete_old_files later in the website generation process.
+        Files already up to date in the output directory are left alone (see sync_static_file).
         """
         self.copied_files = set()
         if not os.path.isdir(self.static_path):
             logging.info("No static dir found at \"%s\"." % self.static_path)
             return
+        updated = 0
         for dirpath, dirnames, filenames in os.walk(self.static_path):
             rel_dir = os.path.relpath(dirpath, self.static_path)
             if rel_dir == os.path.curdir:
                 rel_dir = ""
             out_dir = os.path.join(self.destination, rel_dir)
             if not os.path.isdir(out_dir) and filenames:
-                if os.path.exists(out_dir):
-                    os.remove(out_dir)
-                os.mkdir(out_dir)
+                self.mkdir_f_p(out_dir)
             for filename in filenames:
                 src_path = os.path.join(dirpath, filename) 
                 out_path = os.path.join(out_dir, filename)
                 rel_path = os.path.join(rel_dir, filename)
-                if os.path.isdir(out_path):
-                    shutils.rmtree(out_path)
-                shutil.copy2(src_path, out_path)
+                if os.path.isdir(out_path) and not os.path.islink(out_path):
+                    shutil.rmtree(out_path)
+                if sync_static_file(src_path, out_path, self.static_mode, self.static_hash):
+                    updated += 1
+                    self.profile.count("static_files_copied")
+                else:
+                    self.profile.count("static_files_skipped")
                 self.copied_files.add(rel_path)
+        logging.debug("Updated %d of %d static files." % (updated, len(self.copied_files)))
+
+    def write_search_index(self):
+        """Write a sharded search index of the songs into the SEARCH_DIR directory, for searching the site in a browser.
+
+        The index is made up of JSON files, so a search only needs to download the few small files it uses:
+          index.json: The format version, prefix length, number of songs, and dicts mapping token prefixes to the names
+            of their term shard files, and song slug prefixes to the names of their song shard files.
+          terms/<shard>: The tokens starting with one prefix, mapped to their posting lists (see build_search_index),
+            i.e. the slugs of the songs containing them.
+          songs/<shard>: The slugs of the songs starting with one prefix, mapped to the songs' urls and titles.
+        Each song's tokens are only found once, and only files whose contents change are rewritten (only those of the
+        changed songs' tokens and slugs, when songs change), so this is fast enough to redo whenever songs change.
+        Sets self.search_files.
+        """
+        songs = self.songbook.songs
+        shards = build_search_index(songs)
+        song_shards = collections.defaultdict(dict)
+        for song in songs:
+            song_shards[song.slug[:SEARCH_PREFIX_LENGTH]][song.slug] = [song.url, song.title]
+        files = {}
+        shard_names = {prefix: search_shard_name(prefix) for prefix in sorted(shards)}
+        for prefix, shard_name in shard_names.items():
+            files[posixpath.join("terms", shard_name)] = dict(sorted(shards[prefix].items()))
+        song_shard_names = {prefix: search_shard_name(prefix) for prefix in sorted(song_shards)}
+        for prefix, shard_name in song_shard_names.items():
+            files[posixpath.join("songs", shard_name)] = dict(sorted(song_shards[prefix].items()))
+        files["index.json"] = {"version": SEARCH_FORMAT_VERSION, "prefix_length": SEARCH_PREFIX_LENGTH,
+                               "songs": len(songs), "shards": shard_names, "song_shards": song_shard_names}
+        search_files = set()
+        written = 0
+        for name, contents in files.items():
+            output_filename = os.path.join(SEARCH_DIR, *name.split(posixpath.sep))
+            full_output_path = os.path.join(self.destination, output_filename)
+            self.mkdir_f_p(os.path.dirname(full_output_path))
+            contents = json.dumps(contents, ensure_ascii=False, separators=(",", ":")).encode(OUTPUT_ENCODING)
+            written += self.publish(full_output_path, contents)
+            search_files.add(output_filename)
+        self.search_files = search_files
+        logging.debug("Wrote %d of %d search index files." % (written, len(search_files)))
+
+    def precompress_files(self):
+        """Write compressed copies of compressible output files next to them, for web servers to send as-is.
+
+        Each file in self.created_files, self.copied_files or self.search_files with an extension in COMPRESSIBLE_EXTENSIONS gets a gzipped
+        copy (with ".gz" added to its name), and a brotli compressed copy (".br") if the brotli module is available.
+        Compressed copies are given the same modification time as the original, so those already up to date needn't
+        be compressed again.  Files are compressed by up to self.jobs threads.  Sets self.compressed_files.
+        """
+        encoders = precompression_encoders()
+        output_files = sorted(output_file for output_file in set.union(self.copied_files, self.created_files, self.search_files)
+                              if os.path.splitext(output_file)[1].lower() in COMPRESSIBLE_EXTENSIONS)
+        def precompress(output_file):
+            return precompress_file(os.path.join(self.destination, output_file), encoders)
+        self.compressed_files = set()
+        compressed = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            for output_file, results in zip(output_files, pool.map(precompress, output_files)):
+                for suffix, written in results:
+                    self.compressed_files.add(output_file + suffix)
+                    compressed += written
+        logging.debug("Compressed %d of %d precompressed files." % (compressed, len(self.compressed_files)))
 
     def delete_old_files(self):
-        """Remove contents of self.destination not created, copied in, or specified in self.keep.
+        """Remove files from self.destination which were output by the last build, but not this one.
+
+        The files output by each build (self.copied_files, self.created_files, etc.) are recorded in a manifest (kept in
+        memory, and saved in the destination as MANIFEST_FILENAME, so every build updates it, with or without a cache),
+        so only files listed in the previous manifest need to be checked, rather than every file in the destination.
+        Files in self.keep are never removed.  If there's no previous manifest (or it's unreadable, or from a different
+        CACHE_FORMAT_VERSION), or self.full_clean is set, delete_all_old_files is used instead.
+        """
+        output_files = set.union(self.copied_files, self.created_files, self.search_files, self.compressed_files)
+        if self.full_clean or self.load_manifest() is None:
+            self.delete_all_old_files()
+        else:
+            keep_paths = [os.path.normpath(keep_file) for keep_file in self.keep]
+            for output_file in sorted(self.manifest - output_files):
+                if any(in_path(output_file, keep_path) for keep_path in keep_paths):
+                    continue
+                filepath = os.path.join(self.destination, output_file)
+                if os.path.isdir(filepath) and not os.path.islink(filepath):
+                    continue # Replaced by a directory of outputs.
+                try:
+                    os.remove(filepath)
+                    logging.debug("Clearing unused file from output dir: \"%s\"" % filepath)
+                except FileNotFoundError:
+                    pass
+                # Remove any directories left empty.
+                parent = os.path.dirname(output_file)
+                while parent and not any(in_path(parent, keep_path) for keep_path in keep_paths):
+                    try:
+                        os.rmdir(os.path.join(self.destination, parent))
+                    except OSError:
+                        break
+                    logging.debug("Clearing unused dir. from output dir: \"%s\"" % os.path.join(self.destination, parent))
+                    parent = os.path.dirname(parent)
+        self.save_manifest(output_files)
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.destination, MANIFEST_FILENAME)
 
-        kept_files is the union of self.copied_files, self.created_files, and self.keep.
+    def load_manifest(self):
+        """Return the set of files output by the previous build (see delete_old_files), or None if unknown."""
+        if self.manifest is None and not self.rebuild:
+            try:
+                with open(self.manifest_path, encoding="utf-8") as manifest_file:
+                    manifest = json.load(manifest_file)
+                if manifest.get("version") == CACHE_FORMAT_VERSION:
+                    self.manifest = set(manifest["files"])
+                    self.manifest_digests = {output_file: tuple(digest) for output_file, digest
+                                             in manifest.get("digests", {}).items() if isinstance(digest, list) and len(digest) == 2}
+                    self.output_digests = dict(self.manifest_digests)
+            except FileNotFoundError:
+                pass
+            except (ValueError, KeyError, TypeError) as error:
+                logging.warning("Ignoring unreadable manifest \"%s\": %s" % (self.manifest_path, error))
+        return self.manifest
+
+    def save_manifest(self, output_files):
+        """Record the files output by this build (and the digests of the rendered pages among them) in the manifest."""
+        self.output_digests = {output_file: self.output_digests[output_file]
+                               for output_file in sorted(self.created_files) if output_file in self.output_digests}
+        if output_files == self.manifest and self.output_digests == self.manifest_digests:
+            return
+        self.manifest = output_files
+        self.manifest_digests = dict(self.output_digests)
+        os.makedirs(self.destination, exist_ok=True)
+        manifest = {"version": CACHE_FORMAT_VERSION, "files": sorted(output_files), "digests": self.output_digests}
+        publish_file(self.manifest_path, json.dumps(manifest, indent=0).encode("utf-8"))
+
+    def delete_all_old_files(self):
+        """Remove contents of self.destination not created, copied in, or specified in self.keep, by checking every file.
+
+        kept_files is the union of self.copied_files, self.created_files, self.search_files, self.compressed_files,
+        self.keep and the manifest (see delete_old_files).
         Each of these should be a list of paths relative to self.destination which shouldn't be deleted.
 
         Files or directories explicitly specified in kept_files aren't deleted,
         incl. any contents.  Any directories containing items in kept_files thus
         aren't deleted, but other items in them may be.
         """
-        kept_files = set.union(self.copied_files, self.created_files, self.keep)
+        kept_files = set.union(self.copied_files, self.created_files, self.search_files, self.compressed_files, self.keep,
+                               {MANIFEST_FILENAME})
         kept_paths = set() # Files created and files/dirs specified w/ --keep; don't delete (incl. all contents).
         containing_dirs = set() # Dirs containing above; don't delete, but recursively check dir contents.
         for keep_file in kept_files:
@@ -516,62 +2351,437 @@ class SiteBuilder:
                     os.remove(filepath)
                     logging.debug("Clearing unused file from output dir: \"%s\"" % filepath)
 
-    def observed_event(self, event):
-        assert(not event.is_directory)
-        # Handle moved files/dirs as a pair of creation/deletion.
-        # This lets us deal with files moved from one special dir to another w/o complication
-        if event.event_type == "moved" and not event.is_directory:
-            logging.debug(event)
-            self.observed_event(watchdog.events.FileDeletedEvent(event.src_path))
-            self.observed_event(watchdog.events.FileCreatedEvent(event.dest_path))
-            return
+    def update_songs(self, paths):
+        """Reload the song files at the given paths (or every song in the song archive, if the songs are loaded from one),
+        returning the output paths of the pages affected by any changes.
 
-        def in_path(event, path):
-            return not os.path.relpath(event.src_path, path).startswith(os.path.pardir+os.path.sep)
-        if in_path(event, self.songs_path):
-            logging.debug(event)
-            logging.info("Songs changed, re-loading and re-rendering.")
-            self.songbook = SongBook(self.songs_path)
-            self.render_templates()
-            self.delete_old_files()
-        elif in_path(event, self.templates_path):
-            logging.debug(event)
-            logging.info("Templates changed, re-rendering.")
-            self.render_templates()
+        The affected pages are any pages depending on the changed songs (see SongBook.page_dependencies) before or
+        after the change, plus the affected pages of listings of all songs or categories (by output filename, since
+        they may be split into several pages).  Songs whose slugs changed as a result (e.g. a shift in uniquing
+        numbers) are also considered changed, as their pages have moved.
+        """
+        old_dependencies = self.songbook.page_dependencies()
+        old_slugs = {song.filename: song.slug for song in self.songbook.songs}
+        old_signatures = self.listing_page_signatures()
+        if self.songs_archive:
+            changed = self.songbook.update_archive()
+        else:
+            filenames = [os.path.relpath(path, self.songs_path) for path in paths]
+            # watchdog can report changes within a directory that's been moved by the directory's old path, so if any
+            # changed file's directory is missing, check every song file for changes.
+            if any(not os.path.isdir(os.path.join(self.songs_path, os.path.dirname(filename))) for filename in filenames):
+                filenames.append(os.path.curdir)
+            changed = self.songbook.update_songs(filenames)
+        if not changed:
+            logging.info("No songs changed.")
+            return set()
+        self.paginations = {}
+        self.page_specs = None
+        new_dependencies = self.songbook.page_dependencies()
+        changed.update(song.filename for song in self.songbook.songs if old_slugs.get(song.filename) != song.slug)
+        dirty_pages = set()
+        for filename in changed:
+            dirty_pages.update(old_dependencies.get(filename, ()))
+            dirty_pages.update(new_dependencies.get(filename, ()))
+        # Pages listing all songs or categories are affected if they list different songs or categories, or any whose
+        # own pages are affected.  Only the first page of each listing is always affected, as the others are just
+        # slices of the listing.
+        def item_path(item):
+            return os.path.join(SONGS_DIR if isinstance(item, Song) else CATEGORIES_DIR, item.slug)
+        new_signatures = self.listing_page_signatures()
+        listing_pages = set()
+        for page in self.pages()[0]:
+            output_path, template_name, optional, kind, index, page_number = page
+            output_filename = self.page_filename(page)
+            if page_number in (None, 1) or old_signatures.get(output_filename) != new_signatures[output_filename]:
+                listing_pages.add(output_filename)
+            elif any(item_path(item) in dirty_pages for item in self.paginate(kind, index)[page_number - 1].items):
+                listing_pages.add(output_filename)
+        return dirty_pages | listing_pages
+
+    def update_static_file(self, path, event_type):
+        """Copy (or remove) a single file from the static directory after it's been created, modified or deleted."""
+        rel_path = os.path.relpath(path, self.static_path)
+        out_path = os.path.join(self.destination, rel_path)
+        try:
+            if event_type == "created" and rel_path in self.created_files:
+                logging.warning("File \"%s\" from static is shaddowed by a generated file." % rel_path)
+            elif event_type in ("created", "modified"):
+                logging.info("Static file %s, copying '%s'" % (event_type, rel_path))
+                os.makedirs(os.path.dirname(out_path), exist_ok=True)
+                if os.path.isdir(out_path) and not os.path.islink(out_path):
+                    shutil.rmtree(out_path)
+                sync_static_file(path, out_path, self.static_mode, self.static_hash)
+                self.copied_files.add(rel_path)
+            elif event_type in ("deleted",):
+                logging.info("Static file deleted, removing '%s'" % rel_path)
+                os.remove(out_path)
+                self.copied_files.remove(rel_path)
+            else:
+                logging.error("Unknown event type: '%s'" % event_type)
+        except FileNotFoundError as error:
+            logging.debug("File '%s' removed before processing" % error.filename)
+
+    def template_dependencies(self):
+        """Return a dict mapping each template's name to the set of templates it extends, includes or imports.
+
+        Templates referenced indirectly are included, as well as the template itself.  If a template's references can't
+        be determined (e.g. it can't be parsed, or uses a variable for a template name) its value is None instead.
+        """
+        import jinja2.meta
+        references = {}
+        loader = jinja2.FileSystemLoader(self.templates_path) # The sources, even if using precompiled templates.
+        for template_name in loader.list_templates():
+            try:
+                source, filename, uptodate = loader.get_source(self.templates, template_name)
+                referenced = set(jinja2.meta.find_referenced_templates(self.templates.parse(source)))
+            except (jinja2.exceptions.TemplateError, OSError):
+                referenced = None
+            references[template_name] = None if referenced is None or None in referenced else referenced
+        def dependencies(template_name, visited):
+            visited.add(template_name)
+            if template_name not in references:
+                return visited # A missing template, which can still be depended on.
+            if references[template_name] is None:
+                return None
+            for referenced in references[template_name] - visited:
+                if dependencies(referenced, visited) is None:
+                    return None
+            return visited
+        return {template_name: dependencies(template_name, set()) for template_name in references}
+
+    def pages_using_template(self, template_name):
+        """Return the output paths of all pages whose templates depend on template_name (see template_dependencies)."""
+        dependencies = self.template_dependencies()
+        single_pages, multiple_pages = self.pages()
+        return set(page[0] for page in single_pages + multiple_pages if uses_template(dependencies, page[1], template_name))
+
+    def template_outputs(self):
+        """Return a dict mapping each template's name to a list of the pages (or kinds of page) it's used to render."""
+        dependencies = self.template_dependencies()
+        single_pages, multiple_pages = self.pages()
+        page_families = list(dict.fromkeys((posixpath.sep + (page[0] + posixpath.sep if page[0] else ""), page[1])
+                                           for page in single_pages))
+        page_families += [("/songs/[song]/", "song.html"), ("/categories/[category]/", "category.html")]
+        return {template_name: [url for url, page_template in page_families
+                                if page_template in dependencies and uses_template(dependencies, page_template, template_name)]
+                for template_name in dependencies}
+
+    def watches_path(self, path):
+        """Return whether changes to the file at path affect the site, i.e. whether it's within songs, templates or static
+        (or is the song archive)."""
+        return self.is_song_path(path) or any(in_path(path, source_path) for source_path in (self.templates_path, self.static_path))
+
+    def is_song_path(self, path):
+        """Return whether path is where songs are loaded from: within the songs directory, or the song archive if the
+        songs are loaded from one."""
+        if self.songs_archive:
+            return os.path.abspath(path) == os.path.abspath(self.songs_archive.path)
+        return in_path(path, self.songs_path)
+
+    def process_events(self, events, cancelled=None):
+        """Update the site for a batch of changes to the source directory, given as a dict of paths to event types.
+
+        Changed songs are all reloaded together before re-rendering, and only the pages they affect are re-rendered.
+        If cancelled is given, it's checked while rendering, raising RebuildCancelled if it returns True; any pages that
+        still need to be re-rendered (and the search index, if songs changed) are remembered and updated along with the
+        next batch.
+        When previewing, nothing is written; self.listeners are just told which pages need to be rendered again.
+        """
+        with self.lock:
+            self.profile.reset()
+            song_paths = []
+            for path, event_type in sorted(events.items()):
+                logging.debug("%s: %s" % (event_type, path))
+                if self.is_song_path(path):
+                    song_paths.append(path)
+                elif in_path(path, self.templates_path):
+                    template_name = os.path.relpath(path, self.templates_path).replace(os.path.sep, posixpath.sep)
+                    dirty_pages = self.pages_using_template(template_name)
+                    if self.precompiled_templates:
+                        self.templates = self.template_environment() # Back to the templates if the modules are out of date.
+                    logging.info("Template \"%s\" changed, re-rendering %d pages." % (template_name, len(dirty_pages)))
+                    self.dirty_pages.update(dirty_pages)
+                elif in_path(path, self.static_path) and not self.preview:
+                    self.update_static_file(path, event_type)
+            if song_paths:
+                logging.info("Songs changed, re-loading and re-rendering.")
+                dirty_pages = self.update_songs(song_paths)
+                self.search_index_dirty = self.search_index_dirty or bool(dirty_pages)
+                self.dirty_pages.update(dirty_pages)
+            rendered, self.dirty_pages = self.dirty_pages, set()
+            if self.preview:
+                for listener in self.listeners:
+                    listener(rendered)
+                return
+            if rendered:
+                try:
+                    self.render_templates(only=rendered, cancelled=cancelled)
+                except RebuildCancelled:
+                    self.dirty_pages = rendered
+                    raise
+            if self.search_index_dirty and self.search_index:
+                self.write_search_index()
+                self.search_index_dirty = False
+            if self.precompress:
+                self.precompress_files()
             self.delete_old_files()
-        elif in_path(event, self.static_path):
-            logging.debug(event)
-            rel_path = os.path.relpath(event.src_path, self.static_path)
-            out_path = os.path.join(self.destination, rel_path)
+            for listener in self.listeners:
+                listener(rendered)
+
+
+class RebuildCancelled(Exception):
+    """Raised when a rebuild is abandoned because more changes were found while it was running."""
+
+
+class RebuildScheduler:
+    """Collects watchdog events and applies them to a SiteBuilder in batches, on a background thread.
+
+    Events are collected until none have arrived for delay seconds, deduplicated by path, then handled together by
+    SiteBuilder.process_events.  If more events arrive while that's running, it's cancelled and restarted with them.
+    """
+    def __init__(self, site_builder, delay=0.2):
+        self.site_builder = site_builder
+        self.delay = delay
+        self.pending = {}
+        self.last_event_time = 0
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="RebuildScheduler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def watch(self, path, other_directories=()):
+        """Start (and return) a watchdog observer sending this scheduler the events for everything within the directory at
+        path, and for the files directly within any other_directories."""
+        import watchdog.events
+        import watchdog.observers
+        event_handler = watchdog.events.PatternMatchingEventHandler(ignore_patterns=WATCH_IGNORE_PATTERNS)
+        event_handler.on_any_event = self.observed_event
+        observer = watchdog.observers.Observer()
+        observer.schedule(event_handler, path, recursive=True)
+        for directory in other_directories:
+            observer.schedule(event_handler, directory)
+        observer.start()
+        return observer
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+        if self.site_builder.parse_cache:
+            self.site_builder.parse_cache.save() # Including any changes not yet saved (see SongBook.replace_songs).
+
+    def observed_event(self, event):
+        """Add a watchdog event to the pending batch.
+
+        Directories created, deleted or moved within the songs directory are passed on (see SongBook.update_songs, which
+        reloads all the songs within them), since moving a directory of songs needn't produce events for its files.
+        Other directory events (e.g. a directory modified as files change within it) are ignored.
+        """
+        if event.is_directory and event.event_type not in ("created", "deleted", "moved"):
+            return
+        with self.condition:
+            # Handle moved files/dirs as a pair of creation/deletion, and a file closed after writing as a modification.
+            if event.event_type == "moved":
+                changes = [(event.src_path, "deleted"), (event.dest_path, "created")]
+            elif event.event_type == "closed":
+                changes = [(event.src_path, "modified")]
+            elif event.event_type in ("created", "modified", "deleted"):
+                changes = [(event.src_path, event.event_type)]
+            else:
+                return # E.g. opened, or closed without writing.
+            for path, event_type in changes:
+                if not self.site_builder.watches_path(path) or (event.is_directory and not self.site_builder.is_song_path(path)):
+                    continue # E.g. the destination directory, if it's within the source directory.
+                if event_type == "modified" and self.pending.get(path) == "created":
+                    continue # Still a new file, as far as the next rebuild is concerned.
+                self.pending[path] = event_type
+            if self.pending:
+                self.last_event_time = time.monotonic()
+                self.condition.notify()
+
+    def cancelled(self):
+        """Return whether any new events have arrived since the current batch was started."""
+        return bool(self.pending) or self.stopped
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+                while not self.stopped:
+                    quiet_time = self.last_event_time + self.delay - time.monotonic()
+                    if quiet_time <= 0:
+                        break
+                    self.condition.wait(quiet_time)
+                if self.stopped:
+                    return
+                events, self.pending = self.pending, {}
+            logging.debug("Rebuilding for %d changed files." % len(events))
             try:
-                if event.event_type == "created" and rel_path in self.created_files:
-                    logging.warning("File \"%s\" from static is shaddowed by a generated file." % rel_path)
-                elif event.event_type in ("created", "modified"):
-                    logging.info("Static file %s, copying '%s'" % (event.event_type, rel_path))
-                    os.makedirs(os.path.dirname(out_path), exist_ok=True)
-                    if os.path.isdir(out_path):
-                        shutils.rmtree(out_path)
-                    shutil.copy2(event.src_path, out_path)
-                    self.copied_files.add(rel_path)
-                elif event.event_type in ("deleted",):
-                    logging.info("Static file deleted, removing '%s'" % rel_path)
-                    os.remove(out_path)
-                    self.copied_files.remove(rel_path)
-                else:
-                    logging.error("Unknown event type: '%s'" % event.event_type)
-            except FileNotFoundError as error:
-                logging.debug("File '%s' removed before processing" % error.filename)
+                self.site_builder.process_events(events, cancelled=self.cancelled)
+            except RebuildCancelled:
+                logging.info("More changes found, restarting the rebuild.")
+            except SongArchiveError as error:
+                logging.error("%s; waiting for more changes." % error)
+            except SystemExit:
+                logging.error("Rebuild failed; waiting for more changes.")
+            except Exception:
+                logging.exception("Rebuild failed with unhandled exception:")
+
+
+def _initialize_render_worker(site_builder):
+    """Set up a worker process for SiteBuilder.render_templates with its own copy of the site_builder."""
+    global _render_site_builder
+    _render_site_builder = site_builder
+    if site_builder.templates is None:
+        site_builder.templates = site_builder.template_environment()
+
+def _render_pages(pages):
+    """Render a list of pages from SiteBuilder.pages() in a worker process.
+
+    Returns a dict mapping the created files to the digests (and modification times) of their contents, and the stats
+    of a BuildProfile of rendering them.
+    """
+    site_builder = _render_site_builder
+    profile = site_builder.profile
+    site_builder.profile = BuildProfile()
+    try:
+        created_files = [created_file for created_file in map(site_builder.render_page_spec, pages) if created_file]
+        digests = {created_file: site_builder.output_digests[created_file] for created_file in created_files}
+        return digests, site_builder.profile.stats()
+    finally:
+        site_builder.profile = profile
+
+
+class FileCache:
+    """A thread-safe, size-limited LRU cache of the contents of files, for serving them without reading them each time.
+
+    Entries are keyed by path, and are only used while the file's modification time and size are unchanged.
+    Files larger than an eighth of the cache aren't cached.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """Return a tuple of the contents, strong ETag, and modification time of the file at path, or None if it's too large.
+
+        Raises OSError if the file can't be read.
+        """
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry[0] == key:
+                self.entries.move_to_end(path)
+                return entry[1:]
+        if stat.st_size > self.max_size // 8:
+            return None
+        with open(path, 'rb') as cached_file:
+            contents = cached_file.read()
+        entry = (key, contents, '"%s"' % hashlib.sha1(contents).hexdigest(), stat.st_mtime)
+        with self.lock:
+            old_entry = self.entries.pop(path, None)
+            if old_entry:
+                self.size -= len(old_entry[1])
+            self.entries[path] = entry
+            self.size += len(contents)
+            while self.size > self.max_size:
+                old_path, old_entry = self.entries.popitem(last=False)
+                self.size -= len(old_entry[1])
+        return entry[1:]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class PageCache:
+    """A thread-safe, size-limited LRU cache of pages rendered on demand by a SiteBuilder, for previewing the site
+    without building it.
+
+    Pages are rendered from the SiteBuilder's songbook when first requested, and kept (up to max_size bytes of them)
+    until they're invalidated by changes to the songs or templates.
+    """
+    def __init__(self, site_builder, max_size):
+        self.site_builder = site_builder
+        self.max_size = max_size
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def filename(self, path, directory=False):
+        """Return the output filename of the page at a URL path relative to the root of the site (e.g. "/songs/" or
+        "/songs/some-title", with directory set if it ended with a "/"), and whether the URL needs a "/" adding to
+        be the page's, or (None, False) if there's no such page."""
+        path = path.strip(posixpath.sep)
+        with self.site_builder.lock:
+            pages = self.site_builder.page_index()
+        index_filename = posixpath.join(path, "index.html")
+        if directory or not path:
+            return (index_filename, False) if index_filename in pages else (None, False)
+        if path in pages:
+            return path, False
+        return (index_filename, True) if index_filename in pages else (None, False)
+
+    def get(self, filename):
+        """Return a tuple of the contents, strong ETag and render time of the page with an output filename (as from
+        self.filename), rendering it if needed, or None if there's no such page.  Template errors are raised."""
+        with self.site_builder.lock: # So the songbook doesn't change while rendering.
+            with self.lock:
+                entry = self.entries.get(filename)
+                if entry:
+                    self.entries.move_to_end(filename)
+                    return entry
+            page = self.site_builder.page_index().get(filename)
+            contents = self.site_builder.render_page_contents(page) if page else None
+            if contents is None:
+                return None
+            entry = (contents, '"%s"' % hashlib.sha1(contents).hexdigest(), time.time())
+            if len(contents) <= self.max_size // 8:
+                with self.lock:
+                    self.entries[filename] = entry
+                    self.size += len(contents)
+                    while self.size > self.max_size:
+                        old_filename, old_entry = self.entries.popitem(last=False)
+                        self.size -= len(old_entry[0])
+        return entry
+
+    def invalidate(self, changed=None):
+        """Drop the cached pages with output paths or filenames in changed (as from SiteBuilder.update_songs), or all of
+        them if changed is None."""
+        changed = None if changed is None else {path.replace(os.path.sep, posixpath.sep) for path in changed}
+        with self.lock:
+            for filename in list(self.entries):
+                if changed is None or filename in changed or posixpath.dirname(filename) in changed:
+                    self.size -= len(self.entries.pop(filename)[0])
 
 
 class Server:
-    """A basic HTTP server that serves documents from a specific document root, not just the current directory."""
-    def __init__(self, document_root, port=8000, base=None):
-        class RootedHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
-            def translate_path(self, path):
-                """Translates a URL path to be a local filesystem path rooted at self.root_directory.
+    """A basic HTTP server that serves documents from a specific document root, not just the current directory.
 
-                Based on the SimpleHTTPRequestHandler implementation, but modified for a different root.
-                """
+    Requests are handled on separate threads, and (if cache_size is non-zero) the contents of up to cache_size bytes
+    of files are kept in memory in self.cache.  Responses include strong ETags, and conditional requests
+    (If-None-Match or If-Modified-Since) are answered with "304 Not Modified" where possible.
+    If a PageCache is given as pages, its pages are served in preference to files (e.g. serving the static directory
+    for a preview of the site).
+    """
+    def __init__(self, document_root, port=8000, base=None, cache_size=DEFAULT_SERVER_CACHE_SIZE, pages=None):
+        import http.server
+        import email.utils
+        cache = self.cache = FileCache(cache_size) if cache_size else None
+        self.pages = pages
+        class RootedHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+            def site_path(self, path):
+                """Return a URL path normalized and relative to base, or None (after sending an error) if it's outside base."""
+                path = path.split('?', 1)[0].split('#', 1)[0]
                 path = posixpath.normpath(urllib.parse.unquote(path))
                 if base:
                     if path.startswith(base + posixpath.sep):
@@ -580,7 +2790,18 @@ class Server:
                         path = posixpath.sep
                     else:
                         self.send_error(403, "Only serving files under '%s'" % base)
-                        return "/dev/null/nonexistant" # Hack to make opening the path fail.
+                        return None
+                return path
+
+            def translate_path(self, path):
+                """Translates a URL path to be a local filesystem path rooted at self.root_directory.
+
+                Based on the SimpleHTTPRequestHandler implementation, but modified for a different root.
+                Returns None (after sending an error) for paths outside of base.
+                """
+                path = self.site_path(path)
+                if path is None:
+                    return None
                 words = path.split('/')
                 words = filter(None, words)
                 path = document_root
@@ -592,6 +2813,120 @@ class Server:
                     path = os.path.join(path, word)
                 return path
 
+            def send_head(self):
+                """Send the response headers for a GET or HEAD request, returning a file object for the body, if any.
+
+                Files are served from the cache (if any), with ETag and Cache-Control headers, and conditional requests
+                are answered with 304 if the file hasn't changed.  If the client accepts it, an up to date precompressed
+                copy of the file (see SiteBuilder.precompress_files) is sent instead, with a Content-Encoding header.
+                Anything else (redirects, directory listings, and errors) is handled as in SimpleHTTPRequestHandler.
+                """
+                if pages is not None:
+                    site_path = self.site_path(self.path)
+                    if site_path is None:
+                        return None
+                    filename, redirect = pages.filename(site_path, self.path.split('?', 1)[0].endswith('/'))
+                    if redirect:
+                        parts = urllib.parse.urlsplit(self.path)
+                        self.send_response(301)
+                        self.send_header("Location", urllib.parse.urlunsplit(parts._replace(path=parts.path + '/')))
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return None
+                    if filename:
+                        try:
+                            entry = pages.get(filename)
+                        except Exception as exception:
+                            logging.error("Error rendering \"%s\": %s" % (filename, exception))
+                            self.send_error(500, "Error rendering page", str(exception))
+                            return None
+                        if entry:
+                            contents, etag, mtime = entry
+                            return self.send_body(io.BytesIO(contents), len(contents), etag, mtime, self.guess_type(filename))
+                path = self.translate_path(self.path)
+                if path is None:
+                    return None
+                if os.path.isdir(path) and self.path.split('?', 1)[0].endswith('/'):
+                    for index in ("index.html", "index.htm"):
+                        if os.path.isfile(os.path.join(path, index)):
+                            path = os.path.join(path, index)
+                            break
+                if not os.path.isfile(path):
+                    return super().send_head()
+                content_path, encoding = self.choose_encoding(path)
+                try:
+                    entry = cache.get(content_path) if cache else None
+                    if entry is None:
+                        body = open(content_path, 'rb')
+                        stat = os.fstat(body.fileno())
+                        entry = (body, '"%x-%x"' % (stat.st_mtime_ns, stat.st_size), stat.st_mtime)
+                        length = stat.st_size
+                    else:
+                        length = len(entry[0])
+                        entry = (io.BytesIO(entry[0]),) + entry[1:]
+                except OSError:
+                    self.send_error(404, "File not found")
+                    return None
+                body, etag, mtime = entry
+                return self.send_body(body, length, etag, mtime, self.guess_type(path), encoding)
+
+            def send_body(self, body, length, etag, mtime, content_type, encoding=None):
+                """Send the response headers for a file object body (of length bytes, and the given ETag, modification
+                time, type, and Content-Encoding, if any), or a 304 if the client already has it, returning body if it
+                should be sent."""
+                if self.not_modified(etag, mtime):
+                    body.close()
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Cache-Control", "no-cache")
+                    self.send_header("Vary", "Accept-Encoding")
+                    self.end_headers()
+                    return None
+                self.send_response(200)
+                self.send_header("Content-type", content_type)
+                if encoding:
+                    self.send_header("Content-Encoding", encoding)
+                self.send_header("Content-Length", str(length))
+                self.send_header("Last-Modified", self.date_time_string(mtime))
+                self.send_header("ETag", etag)
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Vary", "Accept-Encoding")
+                self.end_headers()
+                return body
+
+            def choose_encoding(self, path):
+                """Return the path of the file to send for path, and its Content-Encoding (or None if uncompressed).
+
+                A precompressed copy is only used if the request's Accept-Encoding allows it, and if it has the same
+                modification time as the original (i.e. it's up to date).
+                """
+                accepted = set()
+                for coding in self.headers.get("Accept-Encoding", "").split(","):
+                    coding, *parameters = [part.strip() for part in coding.split(";")]
+                    if not any(re.fullmatch(r"q=0(\.0*)?", parameter) for parameter in parameters):
+                        accepted.add(coding.lower())
+                for suffix, encoding in ((".br", "br"), (".gz", "gzip")):
+                    if encoding in accepted or "*" in accepted:
+                        try:
+                            if os.stat(path + suffix).st_mtime_ns == os.stat(path).st_mtime_ns:
+                                return path + suffix, encoding
+                        except OSError:
+                            pass
+                return path, None
+
+            def not_modified(self, etag, mtime):
+                """Return whether the request's conditional headers show the client already has this version of a file."""
+                if "If-None-Match" in self.headers:
+                    tags = [tag.strip() for tag in self.headers["If-None-Match"].split(",")]
+                    return etag in tags or "*" in tags
+                if "If-Modified-Since" in self.headers:
+                    try:
+                        since = email.utils.parsedate_to_datetime(self.headers["If-Modified-Since"])
+                    except (TypeError, ValueError, IndexError, OverflowError):
+                        return False
+                    return since.tzinfo is not None and int(mtime) <= since.timestamp()
+                return False
+
             def log_message(self, format, *args):
                 """Log an arbitrary message, modified to use our logging levels and a more compact format."""
                 logging.info("- [%s] %s" % (self.log_date_time_string(), format%args))
@@ -602,12 +2937,20 @@ class Server:
                 year, month, day, hh, mm, ss, x, y, z = time.localtime(now)
                 return "%02d:%02d:%02d" % (hh, mm, ss)
 
-        self.httpd = http.server.HTTPServer(("", port), RootedHTTPRequestHandler)
+        self.httpd = http.server.ThreadingHTTPServer(("", port), RootedHTTPRequestHandler)
         self.port = self.httpd.socket.getsockname()[1]
     
     def serve(self):
         self.httpd.serve_forever()
 
+    def invalidate(self, changed=None):
+        """Clear any cached files, and any cached pages with output paths or filenames in changed (or all of them if
+        it's None), e.g. after the site is rebuilt."""
+        if self.cache:
+            self.cache.clear()
+        if self.pages:
+            self.pages.invalidate(changed)
+
 
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
@@ -624,8 +2967,68 @@ def main():
 
     parser.add_argument("--base", help="A directory from which the website expects to be served.  Provided for inclusion in "
                         "templates as well as used when serving the website for testing.", default=posixpath.sep)
-    parser.add_argument("--serve", help="Start a basic webserver for testing after building, default port is %(const)d.  Implies --watch.",
-                        dest="port", type=int, const=8000, nargs="?", default=None)
+    serve_args = parser.add_mutually_exclusive_group()
+    serve_args.add_argument("--serve", help="Start a basic webserver for testing after building, default port is %(const)d.  Implies --watch.",
+                            dest="port", type=int, const=8000, nargs="?", default=None)
+    serve_args.add_argument("--preview", help="Start a webserver which renders each page when it's requested, rather than "
+                            "building the site first (files are served from the static directory), default port is "
+                            "%(const)d.  Implies --watch.", dest="preview_port", type=int, const=8000, nargs="?", default=None)
+    parser.add_argument("-j", "--jobs", help="The number of worker processes to use for parsing songs and rendering pages.  "
+                        "0 uses one per CPU. (Default: %(default)d).", type=int, default=1)
+    parser.add_argument("--profile", help="Print how long each phase of the build took (and other statistics), and write "
+                        "them to a JSON file. (Default file: %(const)s).", nargs="?", const="songbook-profile.json", default=None)
+    parser.add_argument("--profile-stats", help="Also profile the code run in each phase of the build with cProfile, and write "
+                        "the stats of the slowest phase to this file (for use with pstats).  Implies --profile.")
+    parser.add_argument("--include", help="A pattern (e.g. 'hymns/*.txt') of song files to include, relative to the songs "
+                        "directory; may be given several times. (Default: '%s')." % "', '".join(SONG_PATTERNS), action="append")
+    parser.add_argument("--exclude", help="A pattern of song files or directories to leave out, relative to the songs "
+                        "directory (e.g. 'drafts'); may be given several times.", action="append", default=[])
+    parser.add_argument("--encoding", help="The text encoding of the song files. (Default: %(default)s).", default=SONG_ENCODING)
+    parser.add_argument("--songs-archive", help="Load the songs from this song archive (a SQLite database, or a JSON Lines "
+                        "file), rather than from the songs directory.  (Its format is chosen by its extension: %s)."
+                        % ", ".join(SONG_ARCHIVE_FORMATS), metavar="FILE")
+    archive_args = parser.add_mutually_exclusive_group()
+    archive_args.add_argument("--export-songs", help="Write the song files in the songs directory into a new song archive "
+                              "(as for --songs-archive), then exit.", metavar="FILE")
+    archive_args.add_argument("--import-songs", help="Write the songs in a song archive into song files in the songs "
+                              "directory, then exit.", metavar="FILE")
+    parser.add_argument("--read-threads", help="The number of threads reading song files at once, when not using worker "
+                        "processes. (Default: %(default)d).", type=int, default=READ_THREADS)
+    page_args = parser.add_mutually_exclusive_group()
+    page_args.add_argument("--page-size", help="Split pages listing all the songs or categories (and category pages) into "
+                           "pages of this many songs or categories each. (Default: 0, not split).", type=int, default=0)
+    page_args.add_argument("--page-by-letter", help="Split pages listing all the songs or categories (and category pages) "
+                           "into a page for each initial letter.", action="store_true")
+    parser.add_argument("--low-memory", help="Only keep the songs' titles, tags, etc. in memory, re-reading their lyrics "
+                        "from their files whenever needed, rather than keeping them all.  Slower (and doesn't use the "
+                        "cache of parsed songs), but uses much less memory for large songbooks.", action="store_true")
+    parser.add_argument("--search-index", help="Write a search index of the songs' titles and lyrics into a 'search/' "
+                        "directory in the destination, for searching the site in a browser.", action="store_true")
+    parser.add_argument("--precompress", help="Write gzip (and brotli, if available) compressed copies of HTML, CSS, etc. files "
+                        "next to them in the destination, for web servers to send to browsers which accept them.", action="store_true")
+    parser.add_argument("--full-clean", help="Check every file in the destination for removal, rather than only those output "
+                        "by the previous build.", action="store_true")
+    parser.add_argument("--staged", help="Build the whole site in a separate directory, then swap it in place of the destination "
+                        "once finished, rather than updating the destination file by file.", action="store_true")
+    parser.add_argument("--static-mode", help="How to put files from the static directory in the destination: copy them, or "
+                        "hardlink, reflink (copy-on-write clone) or symlink to them. (Default: %(default)s).",
+                        choices=STATIC_MODES, default="copy")
+    parser.add_argument("--static-hash", help="Compare the contents of static files with existing copies, not just their "
+                        "size and modification time, when checking whether they need to be copied again.", action="store_true")
+    parser.add_argument("--compile-templates", help="Compile the templates into Python modules in this directory (for "
+                        "use with --precompiled-templates), then exit.", metavar="DIR")
+    parser.add_argument("--precompiled-templates", help="Load the templates from modules compiled with --compile-templates "
+                        "in this directory, rather than compiling them (unless they've changed since).", metavar="DIR")
+    parser.add_argument("--cache-dir", help="The directory in which to cache parsed songs (and compiled templates) between builds. "
+                        "(Default: a '.songbook-cache/' directory within the source directory.).")
+    cache_args = parser.add_mutually_exclusive_group()
+    cache_args.add_argument("--no-cache", help="Don't read or write the cache of parsed songs; parse every song file.", action="store_true")
+    cache_args.add_argument("--rebuild", help="Ignore any existing cache of parsed songs, re-parsing every song file and "
+                            "replacing the cache.", action="store_true")
+    parser.add_argument("--watch-delay", help="When watching, the number of seconds to wait for changes to stop before "
+                        "rebuilding the site. (Default: %(default)s).", type=float, default=0.2)
+    parser.add_argument("--serve-cache", help="The number of megabytes of files the webserver can keep in memory, or 0 to "
+                        "always read them from disk. (Default: %(default)d).", type=int, default=DEFAULT_SERVER_CACHE_SIZE >> 20)
     watch_args = parser.add_mutually_exclusive_group()
     watch_args.add_argument("-w", "--watch", help="Watch the source directory for changes, rebuilding the site when they occur.",
                             action="store_true", default=None)
@@ -634,9 +3037,20 @@ def main():
     args = parser.parse_args()
     if not args.destination:
         args.destination = os.path.join(args.source, "site")
+    if args.jobs < 1:
+        args.jobs = os.cpu_count() or 1
+    if args.profile_stats and not args.profile:
+        args.profile = "songbook-profile.json"
+    if args.no_cache:
+        args.cache_dir = None
+    elif not args.cache_dir:
+        args.cache_dir = os.path.join(args.source, ".songbook-cache")
     # If serving the created site, turn on watching unless explicitly disabled.
-    if args.port != None and args.watch != False:
+    if (args.port != None or args.preview_port != None) and args.watch != False:
         args.watch = True
+    if not args.include:
+        args.include = list(SONG_PATTERNS)
+    args.read_threads = max(args.read_threads, 1)
     args.base = args.base.strip(posixpath.sep)
     if args.base:
         args.base = posixpath.sep + args.base
@@ -648,35 +3062,93 @@ def main():
         log_level = logging.INFO
     elif args.verbose >= 2:
         log_level = logging.DEBUG
-    logging.basicConfig(level=log_level, format="%(levelname)s: %(message)s")
-    logging.getLogger('MARKDOWN').setLevel(logging.WARNING)
+    configure_logging(log_level)
+
+    try:
+        codecs.lookup(args.encoding)
+    except LookupError:
+        logging.error("Unknown encoding '%s'" % args.encoding)
+        sys.exit(os.EX_USAGE)
+    for archive_path in (args.songs_archive, args.export_songs, args.import_songs):
+        if archive_path and os.path.splitext(archive_path)[1].lower() not in SONG_ARCHIVE_FORMATS:
+            logging.error("Unknown song archive format '%s' (expected a file ending with one of: %s)"
+                          % (archive_path, ", ".join(SONG_ARCHIVE_FORMATS)))
+            sys.exit(os.EX_USAGE)
 
     if args.watch:
-        try:
-            global watchdog
-            import watchdog
-            import watchdog.observers
-            import watchdog.events
-        except ImportError as error:
+        if importlib.util.find_spec("watchdog") is None:
             logging.warning("Watching for changes requires the 'watchdog' module; please check the installation instructions. "\
                             "Disabling watching until module is installed (or use --nowatch to avoid this warning)")
             args.watch = False
 
     observer = None
+    scheduler = None
     try:
-        site_builder = SiteBuilder(args.source, args.destination, args.keep, args.base)
-        site_builder.build_site()
+        songs_path = os.path.join(args.source, "songs")
+        if args.export_songs:
+            if not os.path.isdir(songs_path):
+                logging.error("Source directory does not contain a songs subdirectory")
+                sys.exit(os.EX_NOINPUT)
+            count = export_songs(songs_path, args.export_songs, include=args.include, exclude=args.exclude,
+                                 encoding=args.encoding, read_threads=args.read_threads)
+            logging.warning("Exported %d songs to \"%s\"" % (count, args.export_songs))
+            return
+        if args.import_songs:
+            if not os.path.isfile(args.import_songs):
+                logging.error("Could not find song archive '%s'" % args.import_songs)
+                sys.exit(os.EX_NOINPUT)
+            count, written = import_songs(args.import_songs, songs_path, encoding=args.encoding)
+            logging.warning("Imported %d songs into \"%s\" (%d files written)" % (count, songs_path, written))
+            return
+        if args.compile_templates:
+            templates_path = os.path.join(args.source, "templates")
+            if not os.path.isdir(templates_path):
+                logging.error("Source directory does not contain a templates subdirectory")
+                sys.exit(os.EX_NOINPUT)
+            count = compile_templates(templates_path, args.compile_templates)
+            logging.warning("Compiled %d templates into \"%s\"" % (count, args.compile_templates))
+            return
+        site_builder = SiteBuilder(args.source, args.destination, args.keep, args.base,
+                                   cache_dir=args.cache_dir, rebuild=args.rebuild, jobs=args.jobs, staged=args.staged,
+                                   static_mode=args.static_mode, static_hash=args.static_hash, full_clean=args.full_clean,
+                                   precompress=args.precompress, search_index=args.search_index,
+                                   profile=BuildProfile(profile_code=bool(args.profile_stats)), low_memory=args.low_memory,
+                                   page_size=max(args.page_size, 0), page_by_letter=args.page_by_letter,
+                                   include=args.include, exclude=args.exclude, encoding=args.encoding,
+                                   read_threads=args.read_threads, precompiled_templates=args.precompiled_templates,
+                                   preview=args.preview_port != None, songs_archive=args.songs_archive)
+        if args.preview_port != None:
+            site_builder.load_songbook() # Pages are rendered by the server as they're requested.
+        else:
+            site_builder.build_site()
+        if args.profile:
+            print(site_builder.profile.format_report())
+            with open(args.profile, 'w') as profile_file:
+                json.dump(site_builder.profile.report(), profile_file, indent=2)
+            logging.warning("Wrote profile to \"%s\"" % args.profile)
+            if args.profile_stats:
+                phase = site_builder.profile.dump_hottest_phase(args.profile_stats)
+                logging.warning("Wrote cProfile stats of the slowest phase (%s) to \"%s\"" % (phase, args.profile_stats))
 
         if args.watch:
-            logging.warning("Watching for changes and regenerating site.%s" % ("  ^C to kill..." if args.port == None else ""))
-            event_handler = watchdog.events.PatternMatchingEventHandler(ignore_patterns=["*/.DS_Store", "*/Thumbs.db", "*.swp", "*.swo", "*~"], ignore_directories=True)
-            event_handler.on_any_event = site_builder.observed_event
-            observer = watchdog.observers.Observer()
-            observer.schedule(event_handler, args.source, recursive=True)
-            observer.start()
-
-        if args.port != None:
-            server = Server(args.destination, args.port, base=args.base)
+            logging.warning("Watching for changes and regenerating site.%s"
+                            % ("  ^C to kill..." if args.port == None and args.preview_port == None else ""))
+            scheduler = RebuildScheduler(site_builder, delay=args.watch_delay)
+            scheduler.start()
+            other_directories = []
+            if args.songs_archive and not in_path(args.songs_archive, args.source):
+                other_directories.append(os.path.dirname(os.path.abspath(args.songs_archive)))
+            observer = scheduler.watch(args.source, other_directories)
+
+        if args.preview_port != None:
+            server = Server(site_builder.static_path, args.preview_port, base=args.base, cache_size=args.serve_cache << 20,
+                            pages=PageCache(site_builder, args.serve_cache << 20))
+            site_builder.listeners.append(server.invalidate)
+            logging.warning("Starting preview webserver on port %d.  ^C to kill..." % server.port)
+            server.serve()
+        elif args.port != None:
+            server = Server(args.destination, args.port, base=args.base, cache_size=args.serve_cache << 20)
+            site_builder.listeners.append(server.invalidate)
             logging.warning("Starting webserver on port %d.  ^C to kill..." % server.port)
             server.serve()
         elif args.watch:
@@ -687,6 +3159,9 @@ def main():
         raise
     except KeyboardInterrupt:
         logging.info("Keyboard interrupt, terminating application.")
+    except SongArchiveError as error:
+        logging.error(error)
+        sys.exit(os.EX_DATAERR)
     except:
         logging.exception("Failed with unhandled exception:")
         sys.exit(1)
@@ -694,6 +3169,8 @@ def main():
         if observer:
             observer.stop()
             observer.join()
+        if scheduler:
+            scheduler.stop()
         logging.shutdown()
 
 if __name__ == "__main__":